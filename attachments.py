@@ -0,0 +1,73 @@
+from config import Config
+from journal import Journal
+from concurrent.futures import Future
+import tempfile
+import threading
+import hashlib
+import logging
+import os
+
+
+class AttachmentStore:
+    """
+    Content-addressed local store of the jira attachments:
+    - the files are streamed to disk by chunks, and stored under their sha256 (<folder>/<sha[:2]>/<sha>),
+      so that files with the same name do not overwrite each other
+    - identical files are uploaded to clubhouse only once: the file id is reused for all the attachments
+      with the same content (also across runs, if a journal is used)
+    The methods are thread-safe: attachments are downloaded and uploaded by the workers of the scheduler.
+    """
+    chunk_size = 1024 * 1024
+    uploads = {}  # sha256 -> Future of the clubhouse file id
+    lock = threading.Lock()
+
+    @classmethod
+    def folder(cls):
+        return Config.get("attachments").get('folder')
+
+    @classmethod
+    def download(cls, attachment):
+        """
+        Download the content of a jira attachment
+        :return: (local file, sha256 of the content)
+        """
+        os.makedirs(cls.folder(), exist_ok=True)
+        sha = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=cls.folder(), delete=False) as f:
+            for chunk in attachment.source.iter_content(cls.chunk_size):
+                sha.update(chunk)
+                f.write(chunk)
+        digest = sha.hexdigest()
+        localfile = os.path.join(cls.folder(), digest[:2], digest)
+        os.makedirs(os.path.dirname(localfile), exist_ok=True)
+        os.replace(f.name, localfile)
+        return localfile, digest
+
+    @classmethod
+    def upload(cls, clubhouse, attachment):
+        """
+        Upload a downloaded attachment, unless a file with the same content was already uploaded
+        :return: the clubhouse file id
+        """
+        with cls.lock:
+            future = cls.uploads.get(attachment.digest)
+            owner = future is None
+            if owner:
+                future = cls.uploads[attachment.digest] = Future()
+        if not owner: # same content uploaded (or being uploaded) by another attachment
+            return future.result()
+        try:
+            id = Journal.get('contents', attachment.digest)
+            if not id:
+                logging.info("Uploading file '{}'".format(attachment.filename))
+                with open(attachment.localfile, 'rb') as f:
+                    response = clubhouse.post('files', files={"file": (attachment.filename, f, attachment.mimeType)})
+                id = response[0]["id"]
+                Journal.record('contents', attachment.digest, id)
+            future.set_result(id)
+            return id
+        except Exception as e:
+            future.set_exception(e)
+            with cls.lock:
+                del cls.uploads[attachment.digest]
+            raise
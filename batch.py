@@ -0,0 +1,77 @@
+from journal import Journal
+import logging
+
+
+class StoryBatch:
+    """
+    A group of stories created with a single request to the bulk story endpoint.
+    The comments and tasks of the stories are included in the story json,
+    and the ids returned by clubhouse are mapped back to the local objects by their external id.
+    """
+    urlbase = 'stories'
+
+    def __init__(self, stories):
+        self.stories = stories
+
+    def save(self, clubhouse):
+        stories = []
+        for s in self.stories:
+            s.target = Journal.get(s.urlbase, s.external_id)
+            if not s.target: # not saved by a previous run
+                stories.append(s)
+        if not stories:
+            return
+        logging.info("Saving {} stories ({} ... {})".format(len(stories), stories[0].name, stories[-1].name))
+        response = clubhouse.post(self.urlbase, 'bulk', json={"stories": [s.json(inline=True) for s in stories]})
+        index = {s.external_id: s for s in stories}
+        for r in response:
+            story = index[r["external_id"]]
+            story.target = r["id"]
+            Journal.record(story.urlbase, story.external_id, story.target)
+            for comment, id in self.match(story.comments, lambda c: c.key, r, "comments"):
+                comment.target = id
+                Journal.record('comments', comment.key, comment.target)
+            for task, id in self.match(story.subtasks, lambda t: t.key, r, "tasks"):
+                task.target = id
+                Journal.record(task.urlbase, task.external_id, task.target)
+
+    @staticmethod
+    def match(items, external_id, response, key):
+        """
+        Map the local comments (or tasks) of a story to the ids returned by clubhouse:
+        by external id if the response contains the full objects, otherwise by position in the list of ids
+        """
+        if key in response:
+            index = {external_id(i): i for i in items}
+            return [(index[e["external_id"]], e["id"]) for e in response[key] if e.get("external_id") in index]
+        ids = response.get(key[:-1] + "_ids", [])
+        return list(zip(items, ids))
+
+
+class StoryBatcher:
+    """
+    Collects the stories to schedule, and schedules them by batches of a given size (see StoryBatch).
+    A batch is run after all the jobs the stories of the batch depend on (project, epics, files)
+    """
+    def __init__(self, scheduler, clubhouse, size):
+        self.scheduler = scheduler
+        self.clubhouse = clubhouse
+        self.size = size
+        self.stories = []
+        self.after = []
+
+    def add(self, story, after=()):
+        self.stories.append(story)
+        self.after.extend(j for j in after if j not in self.after)
+        if len(self.stories) >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Schedule the collected stories. Must be called after the last story is added"""
+        if not self.stories:
+            return
+        job = self.scheduler.add(StoryBatch(self.stories).save, self.clubhouse, after=self.after)
+        for s in self.stories:
+            s.job = job
+        self.stories = []
+        self.after = []
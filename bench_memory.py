@@ -0,0 +1,33 @@
+"""
+Memory benchmark of the extracted issue tree: memory retained per issue once a project is loaded.
+The project is read from a Jira XML export (see jiraxml.py), so that the benchmark runs offline:
+    python bench_memory.py --xml SearchRequest2.xml --project OP
+"""
+import argparse
+import tracemalloc
+import gc
+from config import Config
+from jiraxml import JiraXmlExport
+from project import Project
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', '-c', default='mapping.json')
+parser.add_argument('--xml', '-x', default='SearchRequest2.xml')
+parser.add_argument('--project', '-p', default='OP')
+args = parser.parse_args()
+Config.load(args.config)
+
+tracemalloc.start()
+start = tracemalloc.get_traced_memory()[0]
+export = JiraXmlExport(args.xml)
+project = Project(export, args.project, export.get_project_index(args.project))
+gc.collect()
+size, peak = tracemalloc.get_traced_memory()
+size -= start
+peak -= start
+
+stories = list(project.issue_index.values())
+issues = len(project.epics) + len(stories) + sum(len(s.subtasks) for s in stories)
+print("{} issues, {} comments".format(issues, sum(len(i.comments) for i in project.epics + stories)))
+print("retained: {:.0f} KB, {:.0f} bytes per issue".format(size / 1024, size / issues))
+print("peak:     {:.0f} KB".format(peak / 1024))
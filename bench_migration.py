@@ -0,0 +1,98 @@
+"""
+Migration benchmark: migrates synthetic projects from a local jira stand-in to a local clubhouse stand-in
+(see bench_servers.py), and reports the wall time, the requests per endpoint and the peak memory.
+The benchmark options describe the workspace and the servers, the other options are passed to jira2clubhouse:
+    python bench_migration.py --stories 1000 --latency 0.05 --rate 50 --workers 8 --batch 50
+"""
+from multiprocessing import Process, Pipe
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import requests
+import json
+import time
+import sys
+import os
+from clubhouse import ClubhouseClient
+import jira2clubhouse
+from bench_servers import SyntheticWorkspace, serve
+
+parser = argparse.ArgumentParser(allow_abbrev=False, epilog="Other options are passed to jira2clubhouse (e.g. --workers 8 --batch 50)")
+parser.add_argument('--projects', type=int, default=1)
+parser.add_argument('--epics', type=int, default=10) # per project
+parser.add_argument('--stories', type=int, default=200) # per project
+parser.add_argument('--comments', type=float, default=2) # per story (average)
+parser.add_argument('--subtasks', type=float, default=0.5) # per story (average)
+parser.add_argument('--links', type=float, default=0.5) # per story (average)
+parser.add_argument('--cross_links', type=float, default=0.2) # fraction of the links to another project
+parser.add_argument('--sprints', type=int, default=5) # per project
+parser.add_argument('--attachments', type=float, default=0.2) # per story (average)
+parser.add_argument('--attachment_size', type=int, default=50000) # bytes (average)
+parser.add_argument('--watchers', type=float, default=1) # per issue (average)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--latency', type=float, default=0.02) # seconds added to each response
+parser.add_argument('--rate', type=float, default=0) # max requests per second of each server (0 = no limit)
+parser.add_argument('--errors', type=float, default=0) # fraction of the writes failing with a 503 (after they are done)
+parser.add_argument('--tracemalloc', action='store_true') # measure the peak of the python allocations (slower)
+parser.add_argument('--report') # json file receiving the results
+args, migration_args = parser.parse_known_args()
+
+## Start the servers (in another process)
+workspace_options = {k: getattr(args, k) for k in ["projects", "epics", "stories", "comments", "subtasks", "links",
+                                                   "cross_links", "sprints", "attachments", "attachment_size",
+                                                   "watchers", "seed"]}
+connection, server_connection = Pipe()
+servers = Process(target=serve, args=(server_connection, workspace_options, args.latency, args.rate, args.errors), daemon=True)
+servers.start()
+server_connection.close()
+jira_url, clubhouse_url, issues = connection.recv()
+sys.modules[ClubhouseClient.__module__].ENDPOINT_HOST = clubhouse_url
+
+## Migrate
+folder = tempfile.mkdtemp(prefix="bench-")
+config = os.path.join(folder, "mapping.json")
+with open(config, "w") as f:
+    json.dump(SyntheticWorkspace.config(os.path.join(folder, "attachments")), f)
+projects = ["BENCH{}".format(n + 1) for n in range(args.projects)]
+argv = ["--config", config, "--jira_server", jira_url, "--jira_user", "bench", "--jira_token", "bench",
+        "--clubhouse_token", "bench", "--log", "WARNING", "--rate_limit", str(args.rate * 60),
+        "--project"] + projects + migration_args
+if args.tracemalloc:
+    tracemalloc.start()
+start = time.time()
+failed = False
+try:
+    jira2clubhouse.main(argv)
+except SystemExit as e:
+    failed = bool(e.code)
+elapsed = time.time() - start
+
+## Report
+results = {
+    "issues": issues,
+    "failed": failed,
+    "seconds": round(elapsed, 2),
+    "issues_per_second": round(issues / elapsed, 1),
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "max_rss_workers_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    "peak_traced_kb": tracemalloc.get_traced_memory()[1] // 1024 if args.tracemalloc else None,
+    "jira": requests.get(jira_url + "/_stats").json(),
+    "clubhouse": requests.get(clubhouse_url + "/_stats").json(),
+}
+connection.close()
+servers.join(5)
+
+print("{} issues in {:.1f}s ({:.1f} issues/s){}".format(issues, elapsed, issues / elapsed, " - FAILED" if failed else ""))
+print("max rss: {} KB (worker processes: {} KB)".format(results["max_rss_kb"], results["max_rss_workers_kb"]))
+if args.tracemalloc:
+    print("peak traced memory: {} KB".format(results["peak_traced_kb"]))
+for server in ["jira", "clubhouse"]:
+    stats = results[server]
+    print("{}: {} requests, {} errors".format(server, sum(s["requests"] for s in stats.values()),
+                                              sum(s["errors"] for s in stats.values())))
+    for endpoint, s in sorted(stats.items()):
+        print("  {:50} {:6} {:6}".format(endpoint, s["requests"], s["errors"] or ""))
+if args.report:
+    with open(args.report, "w") as f:
+        json.dump(results, f, indent=2)
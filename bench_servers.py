@@ -0,0 +1,505 @@
+"""
+Local stand-ins for the Jira and Clubhouse REST APIs, serving a synthetic workspace (see bench_migration.py).
+Only the endpoints used by the migration are implemented. Each server:
+- injects a latency in every response
+- optionally limits its rate (token bucket): over the limit, requests get a 429 with a Retry-After header
+- optionally fails a fraction of the writes (503), after they are done: the worst case for the retries
+- counts the requests per endpoint (GET /_stats)
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime
+import threading
+import random
+import json
+import time
+import re
+
+
+# ----------------------------------------
+# Synthetic workspace
+# ----------------------------------------
+class SyntheticWorkspace:
+    """Synthetic jira projects, with the mapping that migrates them to the stand-in clubhouse"""
+    users = ["user{}".format(n) for n in range(10)]
+    issue_states = {"Backlog": "Unscheduled", "In Progress": "In Development", "Done": "Completed"}
+    epic_states = {"Backlog": "to do", "In Progress": "in progress", "Done": "done"}
+    story_types = {"Story": "feature", "Bug": "bug", "Task": "chore", "Epic": None, "Sub-task": None}
+    link_types = {"Blocks": "blocks", "Relates": "relates to"}
+
+    def __init__(self, projects=1, epics=10, stories=100, comments=2, subtasks=0.5, links=0.5, sprints=5,
+                 attachments=0.2, attachment_size=50000, watchers=1, cross_links=0.2, seed=0):
+        """
+        :param projects, epics, stories, sprints: number of projects, and of epics/stories/sprints per project
+        :param comments, subtasks, links, attachments, watchers: average number per story
+        :param cross_links: fraction of the links to a story of another project
+        """
+        self.random = random.Random(seed)
+        self.projects = {}
+        self.issues = []  # raw jira issues of all projects
+        self.watchers = {}
+        self.sprints = {}
+        self.attachments = {}  # id -> size
+        self.attachment_size = attachment_size
+        stories_keys = [self.generate_project("BENCH{}".format(p + 1), epics, stories, comments, subtasks,
+                                              sprints, attachments, watchers) for p in range(projects)]
+        self.by_key = {i["key"]: i for i in self.issues}
+        self.generate_links(stories_keys, links, cross_links)
+
+    @classmethod
+    def config(cls, folder):
+        """The mapping (configuration file) for the synthetic workspace"""
+        return {
+            "attachments": {"folder": folder},
+            "users": {u: "member_{}".format(u) for u in cls.users},
+            "issue_states": cls.issue_states,
+            "epic_states": cls.epic_states,
+            "subtask_states": {s: s == "Done" for s in cls.issue_states},
+            "link_types": cls.link_types,
+            "story_types": cls.story_types,
+        }
+
+    def count(self, average):
+        """Random count with the given average"""
+        return int(average) + (1 if self.random.random() < average - int(average) else 0)
+
+    def generate_project(self, key, epics, stories, comments, subtasks, sprints, attachments, watchers):
+        """:return: the keys of the stories"""
+        self.projects[key] = {"key": key, "name": "Benchmark {}".format(key), "description": "Synthetic project",
+                              "lead": {"name": self.users[0], "key": self.users[0]}}
+        sprint_ids = []
+        board = len(self.projects)  # one board per project
+        for n in range(sprints):
+            id = len(self.sprints) + 1
+            self.sprints[id] = {"id": id, "name": "{} sprint {}".format(key, n + 1), "state": "closed",
+                                "startDate": "2020-{:02d}-01T09:00:00.000Z".format(1 + n % 12),
+                                "endDate": "2020-{:02d}-14T18:00:00.000Z".format(1 + n % 12), "originBoardId": board}
+            sprint_ids.append(id)
+        numbers = iter(range(1, 10 ** 9))
+        epic_keys = []
+        for n in range(epics):
+            epic = self.issue(key, next(numbers), "Epic", 0, sprint_ids, 0, watchers)
+            epic_keys.append(epic["key"])
+        keys = []
+        for n in range(stories):
+            epic = self.random.choice(epic_keys) if epic_keys and self.random.random() < 0.9 else None
+            story = self.issue(key, next(numbers), self.random.choice(["Story", "Bug", "Task"]),
+                               comments, sprint_ids, attachments, watchers)
+            story["fields"]["customfield_10005"] = epic
+            for t in range(self.count(subtasks)):
+                task = self.issue(key, next(numbers), "Sub-task", 0, [], 0, 0)
+                task["fields"]["parent"] = {"key": story["key"]}
+                story["fields"]["subtasks"].append({"key": task["key"]})
+            keys.append(story["key"])
+        return keys
+
+    def generate_links(self, stories_keys, links, cross_links):
+        """Links between stories, listed by both stories (as in jira: outward and inward links)"""
+        for p, keys in enumerate(stories_keys):
+            others = [k for q, project in enumerate(stories_keys) if q != p for k in project]
+            for k in keys:
+                for l in range(self.count(links)):
+                    target = self.random.choice(others if others and self.random.random() < cross_links else keys)
+                    if target == k:
+                        continue
+                    link = {"id": str(self.random.randrange(10 ** 6)),
+                            "type": {"name": self.random.choice(list(self.link_types))}}
+                    self.by_key[k]["fields"]["issuelinks"].append(dict(link, outwardIssue={"key": target}))
+                    self.by_key[target]["fields"]["issuelinks"].append(dict(link, inwardIssue={"key": k}))
+
+    def issue(self, project, number, issue_type, comments, sprint_ids, attachments, watchers):
+        key = "{}-{}".format(project, number)
+        user = self.random.choice
+        date = "2020-01-{:02d}T10:00:00.000+0000".format(1 + number % 28)
+        fields = {
+            "summary": "{} {} summary".format(issue_type, key),
+            "description": "Description of {}. ".format(key) * 10,
+            "created": date,
+            "updated": date,
+            "duedate": None,
+            "assignee": self.user(user(self.users)) if self.random.random() < 0.7 else None,
+            "reporter": self.user(user(self.users)),
+            "issuetype": {"name": issue_type, "subtask": issue_type == "Sub-task"},
+            "status": {"name": user(list(self.issue_states))},
+            "components": [],
+            "comment": {"comments": [{"id": "{}{:03d}".format(len(self.issues) + 10000, n), "author": self.user(user(self.users)),
+                                      "created": date, "body": "Comment {} on {}".format(n, key)}
+                                     for n in range(self.count(comments))]},
+            "attachment": [],
+            "issuelinks": [],
+            "subtasks": [],
+            "customfield_10005": None,
+            "customfield_10115": None,
+            "watches": {"watchCount": 0},
+        }
+        if sprint_ids and self.random.random() < 0.5:
+            sprint = user(sprint_ids)
+            fields["customfield_10115"] = ["com.atlassian.greenhopper.service.sprint.Sprint@1[id={},rapidViewId={},name={}]"
+                                           .format(sprint, self.sprints[sprint]["originBoardId"], self.sprints[sprint]["name"])]
+        for n in range(self.count(attachments)):
+            id = str(len(self.attachments) + 1)
+            self.attachments[id] = self.random.randrange(self.attachment_size // 2, self.attachment_size * 3 // 2)
+            fields["attachment"].append({"id": id, "self": "{server}/rest/api/2/attachment/" + id, "filename": "file{}.png".format(id), "author": self.user(user(self.users)),
+                                         "created": date, "size": self.attachments[id], "mimeType": "image/png",
+                                         "content": "{server}/secure/attachment/" + id})
+        self.watchers[key] = [self.user(u) for u in self.random.sample(self.users, self.count(watchers))]
+        fields["watches"]["watchCount"] = len(self.watchers[key])
+        issue = {"id": str(len(self.issues) + 10000), "key": key, "fields": fields}
+        self.issues.append(issue)
+        return issue
+
+    @staticmethod
+    def user(name):
+        return {"name": name, "key": name, "displayName": name.title()}
+
+
+# ----------------------------------------
+# HTTP servers
+# ----------------------------------------
+class StandIn:
+    """Base class of the stand-in servers: routing, latency, rate limit and statistics"""
+    routes = []  # (method, path regex, handler name)
+
+    def __init__(self, workspace, latency=0.0, rate=0, burst=10, errors=0.0):
+        self.workspace = workspace
+        self.latency = latency
+        self.errors = errors  # fraction of the writes answered with an error 503 (after they are done)
+        self.rate = rate  # requests per second (0 = no limit)
+        self.burst = burst
+        self.tokens = burst
+        self.refilled = time.time()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.url = None
+
+    def serve(self, port=0):
+        """Start the server in a thread"""
+        standin = self
+
+        class Handler(RequestHandler):
+            server_impl = standin
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(server.server_address[1])
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self.url
+
+    def allow(self):
+        """Token bucket: returns 0 if the request is allowed, otherwise the seconds to wait"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def count(self, endpoint, status, size):
+        with self.lock:
+            s = self.stats.setdefault(endpoint, {"requests": 0, "errors": 0, "bytes": 0})
+            s["requests"] += 1
+            s["errors"] += status >= 400
+            s["bytes"] += size
+
+    def handle(self, method, path, params, body):
+        """:return: (status, json or bytes, headers)"""
+        if path == "/_stats":
+            return 200, self.stats, {}
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                endpoint = "{} {}".format(method, pattern.replace("([^/]+)", "{id}"))
+                wait = self.allow()
+                if wait:
+                    self.count(endpoint, 429, 0)
+                    return 429, {"message": "Too many requests"}, {"Retry-After": str(max(1, round(wait)))}
+                time.sleep(self.latency)
+                status, response = getattr(self, name)(params, body, *match.groups())
+                if method != "GET" and random.random() < self.errors:
+                    status, response = 503, {"message": "Injected error"}
+                self.count(endpoint, status, len(body or b""))
+                return status, response, {}
+        return 404, {"message": "Unknown endpoint {} {}".format(method, path)}, {}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # the headers and the body are written apart: do not wait for the ack of the headers
+    server_impl = None
+
+    def log_message(self, *args):
+        pass
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        status, response, headers = self.server_impl.handle(method, url.path, parse_qs(url.query), body)
+        data = response if isinstance(response, bytes) else json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream" if isinstance(response, bytes) else "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+
+class JiraStandIn(StandIn):
+    """The jira REST endpoints used by jiratools.JiraTools (and the jira client)"""
+    routes = [
+        ("GET", "/rest/api/2/serverInfo", "server_info"),
+        ("GET", "/rest/api/2/myself", "myself"),
+        ("GET", "/rest/api/2/field", "fields"),
+        ("GET", "/rest/api/2/search", "search"),
+        ("GET", "/rest/api/2/project/([^/]+)", "project"),
+        ("GET", "/rest/api/2/issue/([^/]+)/watchers", "watchers"),
+        ("GET", "/rest/agile/1.0/sprint/([^/]+)", "sprint"),
+        ("GET", "/rest/agile/1.0/board/([^/]+)/sprint", "board_sprints"),
+        ("GET", "/secure/attachment/([^/]+)", "attachment"),
+    ]
+    clauses = [
+        (r"project = '(.*)'", lambda i, v: i["key"].split("-")[0] == v),
+        (r"project != '(.*)'", lambda i, v: i["key"].split("-")[0] != v),
+        (r"issuetype = '(.*)'", lambda i, v: i["fields"]["issuetype"]["name"] == v),
+        (r"issuetype != '(.*)'", lambda i, v: i["fields"]["issuetype"]["name"] != v),
+        (r"'Epic Link' = '(.*)'", lambda i, v: i["fields"]["customfield_10005"] == v),
+        (r"'Epic Link' in \((.*)\)", lambda i, v: i["fields"]["customfield_10005"] in v.split(",")),
+        (r"'Epic Link' is EMPTY()", lambda i, v: not i["fields"]["customfield_10005"]),
+        (r"parent = '(.*)'", lambda i, v: i["fields"].get("parent", {}).get("key") == v),
+        (r"parent in \((.*)\)", lambda i, v: i["fields"].get("parent", {}).get("key") in v.split(",")),
+        (r"key in \((.*)\)", lambda i, v: i["key"] in v.split(",")),
+        (r"updated >= '(.*)'", lambda i, v: datetime.strptime(i["fields"]["updated"][:16], "%Y-%m-%dT%H:%M")
+                                            >= datetime.strptime(v, "%Y/%m/%d %H:%M")),
+    ]
+
+    def server_info(self, params, body):
+        return 200, {"versionNumbers": [8, 0, 0], "deploymentType": "Server", "baseUrl": self.url,
+                     "serverTime": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000+0000")}
+
+    def myself(self, params, body):
+        return 200, {"name": "bench", "timeZone": "UTC"}
+
+    def fields(self, params, body):
+        return 200, [{"id": "customfield_10005", "name": "Epic Link", "clauseNames": ["Epic Link", "cf[10005]"]},
+                     {"id": "customfield_10115", "name": "Sprint", "clauseNames": ["Sprint", "cf[10115]"]}]
+
+    def search(self, params, body):
+        jql = params["jql"][0].split(" order by ")[0]
+        tests = []
+        for clause in jql.split(" and "):
+            test = next(((f, m.group(1)) for p, f in self.clauses for m in [re.fullmatch(p, clause.strip())] if m), None)
+            if not test:
+                return 400, {"errorMessages": ["Unsupported clause: {}".format(clause)]}
+            tests.append(test)
+        issues = [i for i in self.workspace.issues if all(f(i, v) for f, v in tests)]
+        start = int(params.get("startAt", ["0"])[0])
+        size = int(params.get("maxResults", ["50"])[0])
+        fields = ",".join(params.get("fields", ["*all"])).split(",")
+        page = [self.project_fields(i, fields) for i in issues[start:start + size]]
+        return 200, {"startAt": start, "maxResults": size, "total": len(issues), "issues": page}
+
+    def project_fields(self, issue, fields):
+        """Copy of the issue with only the requested fields (and the attachment urls of this server)"""
+        values = {k: v for k, v in issue["fields"].items() if "*all" in fields or k in fields}
+        if "attachment" in values:
+            values["attachment"] = [dict(a, self=a["self"].format(server=self.url),
+                                                                        content=a["content"].format(server=self.url)) for a in values["attachment"]]
+        return {"id": issue["id"], "key": issue["key"], "fields": values}
+
+    def project(self, params, body, key):
+        project = self.workspace.projects.get(key)
+        return (200, project) if project else (404, {"errorMessages": ["No project {}".format(key)]})
+
+    def watchers(self, params, body, key):
+        watchers = self.workspace.watchers.get(key, [])
+        return 200, {"watchCount": len(watchers), "watchers": watchers}
+
+    def sprint(self, params, body, id):
+        return 200, self.workspace.sprints[int(id)]
+
+    def board_sprints(self, params, body, id):
+        sprints = [s for s in self.workspace.sprints.values() if str(s["originBoardId"]) == id]
+        start = int(params.get("startAt", ["0"])[0])
+        size = int(params.get("maxResults", ["50"])[0])
+        return 200, {"startAt": start, "maxResults": size, "total": len(sprints),
+                     "isLast": start + size >= len(sprints), "values": sprints[start:start + size]}
+
+    def attachment(self, params, body, id):
+        return 200, bytes(self.workspace.attachments[id])
+
+
+class ClubhouseStandIn(StandIn):
+    """
+    The clubhouse endpoints used by the migration (and the registries).
+    The created objects are kept, so that they can be listed or searched (e.g. by the retries of the client)
+    """
+    routes = [
+        ("GET", "/api/v3/members", "members"),
+        ("GET", "/api/v3/workflows", "workflows"),
+        ("GET", "/api/v3/epic-workflow", "epic_workflow"),
+        ("GET", "/api/v3/projects", "list_projects"),
+        ("GET", "/api/v3/epics", "list_epics"),
+        ("GET", "/api/v3/projects/([^/]+)/stories", "project_stories"),
+        ("GET", "/api/v3/stories/([^/]+)", "get_story"),
+        ("POST", "/api/v3/projects", "create_project"),
+        ("POST", "/api/v3/epics", "create_epic"),
+        ("POST", "/api/v3/stories", "create_story"),
+        ("POST", "/api/v3/stories/bulk", "create_stories"),
+        ("POST", "/api/v3/stories/search", "search_stories"),
+        ("POST", "/api/v3/stories/([^/]+)/comments", "create_comment"),
+        ("POST", "/api/v3/stories/([^/]+)/tasks", "create_task"),
+        ("POST", "/api/v3/story-links", "create_link"),
+        ("POST", "/api/v3/files", "upload"),
+        ("POST", "/api/v3/iterations", "create_iteration"),
+        ("PUT", "/api/v3/epics/([^/]+)", "update"),
+        ("PUT", "/api/v3/stories/([^/]+)", "update"),
+        ("PUT", "/api/v3/stories/([^/]+)/tasks/([^/]+)", "update"),
+        ("DELETE", "/api/v3/stories/bulk", "delete_stories"),
+        ("DELETE", "/api/v3/epics/([^/]+)", "delete_epic"),
+        ("DELETE", "/api/v3/projects/([^/]+)", "delete_project"),
+    ]
+
+    def __init__(self, workspace, **kwargs):
+        super().__init__(workspace, **kwargs)
+        self.ids = iter(range(1, 10 ** 9))
+        self.projects = {}
+        self.epics = {}
+        self.iterations = {}
+        self.stories = {}
+        self.stories_by_external_id = {}
+
+    def new_id(self):
+        with self.lock:
+            return next(self.ids)
+
+    def members(self, params, body):
+        return 200, [{"id": "member-{}".format(u), "profile": {"mention_name": "member_{}".format(u)}}
+                     for u in self.workspace.users]
+
+    def workflows(self, params, body):
+        return 200, [{"states": [{"id": 500 + n, "name": s}
+                                 for n, s in enumerate(self.workspace.issue_states.values())]}]
+
+    def epic_workflow(self, params, body):
+        return 200, {"epic_states": [{"id": 600 + n, "name": s}
+                                     for n, s in enumerate(self.workspace.epic_states.values())]}
+
+    def list_projects(self, params, body):
+        return 200, list(self.projects.values())
+
+    def list_epics(self, params, body):
+        return 200, list(self.epics.values())
+
+    def project_stories(self, params, body, id):
+        """The stories of a project, without their description, comments and tasks (only their ids)"""
+        return 200, [dict({k: v for k, v in s.items() if k not in ("description", "comments", "tasks")},
+                          comment_ids=[c["id"] for c in s["comments"]], task_ids=[t["id"] for t in s["tasks"]])
+                     for s in list(self.stories.values()) if str(s.get("project_id")) == id]
+
+    def get_story(self, params, body, id):
+        story = self.stories.get(int(id))
+        return (200, story) if story else (404, {"message": "No story {}".format(id)})
+
+    def create_project(self, params, body):
+        project = dict(json.loads(body), id=self.new_id())
+        self.projects[project["id"]] = project
+        return 201, project
+
+    def create_epic(self, params, body):
+        epic = dict(json.loads(body), id=self.new_id())
+        self.epics[epic["id"]] = epic
+        return 201, epic
+
+    def create_iteration(self, params, body):
+        iteration = dict(json.loads(body), id=self.new_id())
+        self.iterations[iteration["id"]] = iteration
+        return 201, iteration
+
+    def create_story(self, params, body):
+        return 201, self.story(json.loads(body))
+
+    def create_stories(self, params, body):
+        return 201, [self.story(s) for s in json.loads(body)["stories"]]
+
+    def story(self, story):
+        """A created story, with its comments and tasks"""
+        story = dict(story, id=self.new_id(), story_links=[],
+                     comments=[dict(c, id=self.new_id()) for c in story.get("comments", [])],
+                     tasks=[dict(t, id=self.new_id()) for t in story.get("tasks", [])])
+        self.stories[story["id"]] = story
+        if story.get("external_id"):
+            self.stories_by_external_id[story["external_id"]] = story
+        return story
+
+    def search_stories(self, params, body):
+        story = self.stories_by_external_id.get(json.loads(body).get("external_id"))
+        return 201, [story] if story else []
+
+    def create_comment(self, params, body, story):
+        comment = dict(json.loads(body), id=self.new_id())
+        self.stories[int(story)]["comments"].append(comment)
+        return 201, comment
+
+    def create_task(self, params, body, story):
+        task = dict(json.loads(body), id=self.new_id())
+        self.stories[int(story)]["tasks"].append(task)
+        return 201, task
+
+    def create_link(self, params, body):
+        link = dict(json.loads(body), id=self.new_id())
+        for id in {link["subject_id"], link["object_id"]}:
+            self.stories[id]["story_links"].append(link)
+        return 201, link
+
+    def upload(self, params, body):
+        return 201, [{"id": self.new_id()}]
+
+    def update(self, params, body, *ids):
+        return 200, dict(json.loads(body), id=ids[-1])
+
+    def delete_stories(self, params, body):
+        for id in json.loads(body)["story_ids"]:
+            story = self.stories.pop(id, {})
+            self.stories_by_external_id.pop(story.get("external_id"), None)
+        return 204, b""
+
+    def delete_epic(self, params, body, id):
+        if not self.epics.pop(int(id), None):
+            return 404, {"message": "No epic {}".format(id)}
+        return 204, b""
+
+    def delete_project(self, params, body, id):
+        if not self.projects.pop(int(id), None):
+            return 404, {"message": "No project {}".format(id)}
+        return 204, b""
+
+
+def serve(connection, workspace_options, latency, rate, errors=0.0):
+    """
+    Run both stand-ins (in a separate process, so that they do not disturb the measures),
+    send their urls through the connection, then serve until the connection is closed
+    """
+    workspace = SyntheticWorkspace(**workspace_options)
+    jira = JiraStandIn(workspace, latency=latency, rate=rate, errors=errors)
+    clubhouse = ClubhouseStandIn(workspace, latency=latency, rate=rate, errors=errors)
+    connection.send((jira.serve(), clubhouse.serve(), len(workspace.issues)))
+    try:
+        connection.recv()
+    except EOFError:
+        pass
@@ -0,0 +1,159 @@
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import threading
+import logging
+import json
+import time
+import os
+import re
+
+
+class Trace:
+    """
+    Instrumentation of a run: the duration of each phase (extraction, watchers, downloads, the saving of each
+    kind of object, deletes...) and the latency, status and size of each jira and clubhouse request.
+    The requests are recorded by a 'response' hook of the requests library (see hook() and TracedClient).
+    The results are exported as a summary (summary()) and as a timeline in the Chrome trace format (export(),
+    to open in chrome://tracing or https://ui.perfetto.dev).
+    Like Journal, it is accessed as a class (global) - when it is not enabled, nothing is recorded.
+    """
+    enabled = False
+    events = []  # chrome trace events
+    phases = {}  # phase name -> [count, total seconds, max seconds]
+    calls = {}   # "service method endpoint" -> [count, errors, total seconds, max seconds, bytes sent, bytes received]
+    lock = threading.Lock()
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name, detail=None):
+        """Time the enclosed block as an occurrence of the given phase"""
+        if not cls.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            cls.add_phase(name, start, time.time() - start, detail)
+
+    @classmethod
+    def add_phase(cls, name, start, seconds, detail=None):
+        with cls.lock:
+            stats = cls.phases.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            cls.events.append(cls.event(name, "phase", start, seconds, {"detail": detail} if detail else {}))
+
+    @classmethod
+    def add_call(cls, service, method, endpoint, start, seconds, status, sent, received):
+        name = "{} {} {}".format(service, method, endpoint)
+        with cls.lock:
+            stats = cls.calls.setdefault(name, [0, 0, 0.0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += status >= 400
+            stats[2] += seconds
+            stats[3] = max(stats[3], seconds)
+            stats[4] += sent
+            stats[5] += received
+            cls.events.append(cls.event(name, service, start, seconds, {"status": status}))
+
+    @staticmethod
+    def event(name, category, start, seconds, args):
+        """A 'complete' event of the Chrome trace format (times in microseconds, from the epoch
+        so that the events of several processes are aligned)"""
+        return {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": int(start * 1e6), "dur": int(seconds * 1e6), "args": args}
+
+    # ---- requests
+
+    @classmethod
+    def hook(cls, session, service="jira"):
+        """Record the requests of a requests.Session (e.g. the _session of the jira client)"""
+        session.hooks['response'].append(cls.response_hook(service))
+
+    @classmethod
+    def response_hook(cls, service):
+        def record(response, *args, **kwargs):
+            seconds = response.elapsed.total_seconds()  # until the headers of the response are received
+            request = response.request
+            body = request.body or b""
+            cls.add_call(service, request.method, cls.endpoint(request.url), time.time() - seconds, seconds,
+                         response.status_code, len(body) if isinstance(body, (bytes, str)) else 0,
+                         int(response.headers.get('Content-Length') or 0))
+        return record
+
+    @staticmethod
+    def endpoint(url):
+        """Path of the url, without the query (which may contain the token) and with the ids replaced by {id}"""
+        segments = urlparse(url).path.split("/")
+        return "/".join("{id}" if (re.search(r"\d", s) and previous != "api") or previous == "project" else s
+                        for previous, s in zip([""] + segments, segments))
+
+    # ---- results
+
+    @classmethod
+    def drain(cls):
+        """Returns the recorded data (to be merged in another process) and resets it"""
+        with cls.lock:
+            data = (cls.events, cls.phases, cls.calls)
+            cls.events, cls.phases, cls.calls = [], {}, {}
+        return data
+
+    @classmethod
+    def merge(cls, data):
+        """Add the data drained in another process"""
+        events, phases, calls = data
+        with cls.lock:
+            cls.events.extend(events)
+            for name, stats in phases.items():
+                total = cls.phases.setdefault(name, [0, 0.0, 0.0])
+                cls.phases[name] = [a + b for a, b in zip(total[:2], stats[:2])] + [max(total[2], stats[2])]
+            for name, stats in calls.items():
+                total = cls.calls.setdefault(name, [0, 0, 0.0, 0.0, 0, 0])
+                cls.calls[name] = [a + b for a, b in zip(total, stats)]
+                cls.calls[name][3] = max(total[3], stats[3])
+
+    @classmethod
+    def summary(cls):
+        """Report of the phases and of the requests per endpoint (as a list of lines)"""
+        lines = ["{:45} {:>7} {:>10} {:>9} {:>9}".format("phase", "count", "total (s)", "mean (ms)", "max (ms)")]
+        for name, (count, total, longest) in sorted(cls.phases.items(), key=lambda p: -p[1][1]):
+            lines.append("{:45} {:7} {:10.1f} {:9.0f} {:9.0f}".format(name, count, total, total / count * 1000,
+                                                                     longest * 1000))
+        lines.append("{:45} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9}".format("request", "count", "errors", "mean (ms)",
+                                                                       "max (ms)", "sent (KB)", "recv (KB)"))
+        for name, (count, errors, total, longest, sent, received) in sorted(cls.calls.items(), key=lambda c: -c[1][2]):
+            lines.append("{:45} {:7} {:6} {:9.0f} {:9.0f} {:9.0f} {:9.0f}".format(
+                name, count, errors, total / count * 1000, longest * 1000, sent / 1024, received / 1024))
+        return lines
+
+    @classmethod
+    def export(cls, filename):
+        """Write the timeline in the Chrome trace format"""
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": cls.events, "displayTimeUnit": "ms"}, f)
+        logging.info("Trace: {} events written to {}".format(len(cls.events), filename))
+
+
+class TracedClient:
+    """Wrapper of the clubhouse client: each request is recorded by Trace"""
+    def __init__(self, client):
+        self.client = client
+        self.hooks = {'response': [Trace.response_hook("clubhouse")]}
+
+    def get(self, *args, **kwargs):
+        return self.client.get(*args, hooks=self.hooks, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.client.post(*args, hooks=self.hooks, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self.client.put(*args, hooks=self.hooks, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.client.delete(*args, hooks=self.hooks, **kwargs)
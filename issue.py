@@ -1,47 +1,78 @@
 from config import Config
 from jiratools import JiraTools
 from link import Link
-import os
-from registry import Members, StoryStates, EpicStates
+from journal import Journal
+from attachments import AttachmentStore
+from teardown import Workspace
+from registry import Lookup
+from instrument import Trace
 import re
 import logging
 
+SPRINT_FIELD = re.compile(r"\bid=(\d+)(?:,rapidViewId=(\d+))?")  # jira sprint string: '...Sprint@1[id=3,rapidViewId=1,...'
+
 # ----------------------------------------
 # class Issue
 # ----------------------------------------
 class Issue:
     """
     Generic class for stories and epics
+    Only the fields needed to create the issue in clubhouse are extracted from the jira issue,
+    which is not kept (the objects are slotted to keep the issue tree of large projects small).
+    The comments, watchers, attachments, links and sprints are optional: they are not requested
+    for all the kinds of issues (see JiraTools.epic_fields and JiraTools.subtask_fields)
     """
+    __slots__ = ['jira_client', 'epic', '_project', 'target', 'job', 'key', 'issue_type', 'status',
+                 'name', 'created', 'updated', 'external_id', 'deadline', 'description', 'owners', 'requester',
+                 'comments', 'followers', 'attachments', 'subtasks', 'links', 'sprints']
     urlbase = None
+    update_excluded = ["created_at", "updated_at", "external_id"]  # fields that cannot be changed by an update
 
     def __init__(self, jira_client, jira_issue):
         self.jira_client = jira_client
         self.epic = None
         self._project = None
-        self.source = jira_issue
         self.target = None
-        fields = self.source.fields
+        self.job = None  # scheduler job creating the issue (see schedule())
+        fields = jira_issue.fields
+        self.key = jira_issue.key
+        self.issue_type = fields.issuetype.name
+        self.status = fields.status.name
         self.name = fields.summary
         self.created = fields.created
         self.updated = fields.updated
-        self.external_id = "JIRA_{}".format(self.source.key)
+        self.external_id = "JIRA_{}".format(self.key)
         self.deadline = fields.duedate
         self.description = fields.description
-        self.owners = [Config.get('users').get(fields.assignee.key)] if fields.assignee else None
-        self.requester = Config.get('users').get(fields.reporter.key)
-        self.comments = [Comment(self, c.id, Config.get('users').get(c.author.key), c.created, c.body)
-                         for c in fields.comment.comments]
-        self.components = fields.components
-        self.followers = [Config.get('users').get(u.name) for u in JiraTools.issue_watchers(jira_client, self.source)]
-        self.attachments = [Attachment(a) for a in fields.attachment]
+        # users are stored as jira names, resolved by the Lookup tables when saving
+        self.owners = [fields.assignee.key] if fields.assignee else None
+        self.requester = fields.reporter.key if fields.reporter else None
+        self.comments = [Comment(self, c.id, c.author.key if c.author else None, c.created, c.body)
+                         for c in fields.comment.comments] if hasattr(fields, 'comment') else []
+        self.followers = [u.name for u in JiraTools.issue_watchers(jira_client, jira_issue)] \
+            if hasattr(fields, 'watches') and not fields.issuetype.subtask else []  # (not migrated for the subtasks)
+        self.attachments = [Attachment(a) for a in getattr(fields, 'attachment', [])]
         self.subtasks = None
         self.links = []
-        self.sprints = [re.search("id=([0-9]+),", sprint).group(1) for sprint in fields.customfield_10115] if fields.customfield_10115 else []
-        for link in fields.issuelinks:
+        # replaced by Sprint objects (see Project)
+        self.sprints = [self.parse_sprint(s) for s in getattr(fields, 'customfield_10115', None) or []]
+        for link in getattr(fields, 'issuelinks', []):
             target_type = Config.get("link_types").get(link.type.name)
-            if hasattr(link, 'outwardIssue') and target_type:  # keep only types that exist in the mapping
-                self.links.append(Link(self, link.outwardIssue.key, target_type))
+            if not target_type:  # keep only types that exist in the mapping
+                continue
+            # both ends list the link: the inward link of an issue is kept in case its origin is not in the run
+            if hasattr(link, 'outwardIssue'):
+                self.links.append(Link(self.key, link.outwardIssue.key, target_type))
+            elif hasattr(link, 'inwardIssue'):
+                self.links.append(Link(link.inwardIssue.key, self.key, target_type))
+
+    @staticmethod
+    def parse_sprint(sprint):
+        """:return: (sprint id, board id or None) of a value of the sprint field (a string, or an object on Jira Cloud)"""
+        if not isinstance(sprint, str):
+            return str(sprint.id), getattr(sprint, 'boardId', None)
+        match = SPRINT_FIELD.search(sprint)
+        return match.group(1), match.group(2)
 
     @property
     def project(self):
@@ -50,63 +81,107 @@ class Issue:
     @project.setter
     def project(self, project):
         self._project = project
-        project.add_to_sprints(self, self.sprints) # when project is defined, then add issue to project sprints
 
     def __str__(self):
-        return "<{} {} '{}'>".format(type(self).__name__, self.source.key, self.name)
+        return "<{} {} '{}'>".format(type(self).__name__, self.key, self.name)
+
+    def users(self):
+        """The jira names of the users referenced in the json of the issue and its comments"""
+        return {self.requester} | set(self.owners or []) | set(self.followers) | {c.author for c in self.comments}
 
     def __repr__(self):
         return self.__str__()
 
-    def json(self):
+    def json(self, inline=False):
         """
         Construct the common json for the creattion of all subclasses of issues
+        :param inline: include the comments in the json (instead of saving them separately)
         :return: json (thatt he  caller must complete for the specific class of issues)
         """
         json = {
             "name": self.name,
-            "requested_by_id": Members.get_id(self.requester),
+            "requested_by_id": Lookup.get_id('users', self.requester),
             "created_at": self.created,
             "updated_at": self.updated,
-            "external_id": self.external_id, #"JIRA: {}".format(self.source.key)
+            "external_id": self.external_id, #"JIRA: {}".format(self.key)
         }
 
         if self.deadline: json["deadline"] = self.deadline
         if self.description: json["description"] = self.description
-        if self.owners: json["owner_ids"] = [Members.get_id(o) for o in self.owners]
-        if self.followers: json["follower_ids"] = [Members.get_id(f) for f in self.followers]
-        #if self.comments: json["comments"] = [c.json() for c in self.comments]
-        sprint_labels = [{"name": "Sprint: {}".format(s.name)} for s in self.sprints]
-        if sprint_labels:
-            json["labels"] = sprint_labels
+        if self.owners: json["owner_ids"] = [Lookup.get_id('users', o) for o in self.owners]
+        if self.followers: json["follower_ids"] = [Lookup.get_id('users', f) for f in self.followers]
+        if inline and self.comments: json["comments"] = [c.json() for c in self.comments]
+        if self.sprints:
+            json["labels"] = [s.label for s in self.sprints]
         return json
 
-    def save(self, clubhouse):
+    def create(self, clubhouse):
         """
-        Common method to create all kinds of issues in clubhouse
+        Create the object itself in clubhouse (without its comments)
         """
-        # 1. Create the object
+        self.target = Journal.get(self.urlbase, self.external_id)
+        if self.target: # already saved by a previous run
+            return
+        logging.info("Saving {} '{}'".format(type(self).__name__.lower(), self.name))
         json = self.json()
         response = clubhouse.post(self.urlbase, json=json)
         self.target = response["id"]
+        Journal.record(self.urlbase, self.external_id, self.target)
+
+    def update(self, clubhouse):
+        """
+        Update the object in clubhouse if it was saved by a previous run (see Journal), otherwise create it
+        """
+        self.target = Journal.get(self.urlbase, self.external_id)
+        if not self.target:
+            return self.create(clubhouse)
+        logging.info("Updating {} '{}'".format(type(self).__name__.lower(), self.name))
+        json = {k: v for k, v in self.json().items() if k not in self.update_excluded}
+        clubhouse.put(*self.path(), json=json)
+
+    def path(self):
+        """Url segments of the object in clubhouse"""
+        return self.urlbase, self.target
+
+    def save(self, clubhouse):
+        """
+        Common method to create all kinds of issues in clubhouse
+        """
+        # 1. Create the object
+        self.create(clubhouse)
         [c.save(clubhouse) for c in self.comments]
 
+    def schedule(self, scheduler, clubhouse, after=(), update=False):
+        """
+        Same as save(), but through a scheduler.Scheduler: the issue is created after the given jobs,
+        and its comments are created (concurrently) after the issue
+        :param update: update the issue if it already exists (instead of skipping it)
+        :return: the job that creates the issue
+        """
+        self.job = scheduler.add(self.update if update else self.create, clubhouse, after=after)
+        for c in self.comments:
+            scheduler.add(c.save, clubhouse, after=[self.job])
+        return self.job
+
 
 # ----------------------------------------
 # class Comment
 # ----------------------------------------
 class Comment:
     """ Class for storing comments on an issue"""
+    __slots__ = ['issue', 'key', 'author', 'date', 'comment', 'target']
+
     def __init__(self, issue, key, author, date, comment):
         self.issue = issue
         self.key = key
         self.author = author
         self.date = date
         self.comment = comment
+        self.target = None
 
     def json(self):
         return {
-            "author_id": Members.get_id(self.author),
+            "author_id": Lookup.get_id('users', self.author),
             "created_at": self.date,
             "external_id": self.key,
             "text": self.comment
@@ -114,8 +189,12 @@ class Comment:
 
     def save(self, clubhouse):
         """ Method to save a comment. May be used instead of including the jons in the item creation itself"""
+        self.target = Journal.get('comments', self.key)
+        if self.target:
+            return
         response = clubhouse.post(self.issue.urlbase, self.issue.target, 'comments', json=self.json())
         self.target = response["id"]
+        Journal.record('comments', self.key, self.target)
 
 # ----------------------------------------
 # class Epic
@@ -124,12 +203,17 @@ class Epic(Issue):
     """
     Class to represent Epics
     """
+    __slots__ = ['stories']
     urlbase = 'epics'
 
-    def __init__(self, jira_client, jira_epic):
+    def __init__(self, jira_client, jira_epic, index=None):
+        """
+        :param index: optional jiratools.IssueIndex of the project, to collect the stories locally
+        """
         super().__init__(jira_client, jira_epic)
-        self.status = Config.get('epic_states').get(self.source.fields.status.name)
-        self.stories = [Story(jira_client, s) for s in JiraTools.get_epic_issues(jira_client, epic=self.source.key)]
+        issues = index.get_epic_issues(self.key) if index is not None \
+            else JiraTools.get_epic_issues(jira_client, epic=self.key)
+        self.stories = [Story(jira_client, s, index) for s in issues]
         for s in self.stories:
             s.epic = self
 
@@ -142,23 +226,36 @@ class Epic(Issue):
     def json(self):
         """ Return the json to create the item in Clubhouse """
         json = super().json() # default json
-        json["epic_state_id"] = EpicStates.get_id(self.status)
+        json["epic_state_id"] = Lookup.get_id('epic_states', self.status)
         return json
 
     def save(self, clubhouse):
-        logging.info("Saving epic '{}'".format(self.name))
         self.delete(clubhouse)
         super().save(clubhouse)
         for s in self.stories:
             s.save(clubhouse)
 
+    def schedule(self, scheduler, clubhouse, after=(), update=False, batch=None):
+        """
+        The epic is deleted then created (or only updated), independently of the other jobs.
+        Its stories are created after the epic and after the given jobs (e.g. the project)
+        """
+        deleted = None if update or not self.project.delete_epics else scheduler.add(self.delete, clubhouse)
+        super().schedule(scheduler, clubhouse, after=[deleted], update=update)
+        for s in self.stories:
+            s.schedule(scheduler, clubhouse, after=list(after) + [self.job], update=update, batch=batch)
+        return self.job
+
     def delete(self, clubhouse):
-        # Should search by external id, but it does not work
-        epics = clubhouse.get("search", self.urlbase, json={"query": "name={}".format(self.name)})
-        if epics and epics["total"] > 0:
-                [clubhouse.delete(self.urlbase, e["id"])
-                 for e in epics["data"]
-                 if e["external_id"] == self.external_id]
+        if Journal.get(self.urlbase, self.external_id):
+            return # saved by a previous run: keep it
+        Workspace.delete_epic(clubhouse, self.external_id)
+
+    def export(self, writer):
+        """Write the payloads of the epic and its stories (see payloads.PayloadExport)"""
+        writer.write(self.urlbase, self.external_id, self.json())
+        for s in self.stories:
+            s.export(writer)
 
 # ----------------------------------------
 # class Story
@@ -167,33 +264,42 @@ class Story(Issue):
     """
     Class to represent stories (= Jira issues except epics)
     """
+    __slots__ = ['story_type']
     urlbase = 'stories'
 
-    def __init__(self, jira_client, jira_issue):
+    def __init__(self, jira_client, jira_issue, index=None):
+        """
+        :param index: optional jiratools.IssueIndex of the project, to collect the subtasks locally
+        """
         super().__init__(jira_client, jira_issue)
-        self.story_type = Config.get('story_types').get(self.source.fields.issuetype.name)
-        self.status = Config.get('issue_states').get(self.source.fields.status.name)
+        self.story_type = Config.get('story_types').get(self.issue_type)
         self.subtasks = []
-        if jira_issue.fields.subtasks:
-            self.subtasks = [Subtask(jira_client, s) for s in JiraTools.get_subtasks(jira_client, jira_issue.key)]
+        if getattr(jira_issue.fields, 'subtasks', None):
+            issues = index.get_subtasks(jira_issue.key) if index is not None \
+                else JiraTools.get_subtasks(jira_client, jira_issue.key)
+            self.subtasks = [Subtask(jira_client, s) for s in issues]
             for s in self.subtasks:
                 s.parent = self
 
-    def json(self):
-        """ Return the json to create the item in Clubhouse """
-        json = super().json() # default json for all issues
-        json["workflow_state_id"] = StoryStates.get_id(self.status)
+    def json(self, inline=False):
+        """ Return the json to create the item in Clubhouse (optionally with its comments and tasks) """
+        json = super().json(inline) # default json for all issues
+        json["workflow_state_id"] = Lookup.get_id('issue_states', self.status)
         json["story_type"] = self.story_type
         if self.epic:
             json["epic_id"] = self.epic.target
         if self.project:
             json["project_id"] = self.project.target
         if self.attachments:  # attachments must be uploaded beforehand
-            json["file_ids"] = [a.target for a in self.attachments]
+            json["file_ids"] = list(dict.fromkeys(a.target for a in self.attachments)) # same content => same file
+        if inline and self.subtasks:
+            json["tasks"] = [t.json() for t in self.subtasks]
+        iteration = next((s.target for s in reversed(self.sprints) if s.target), None)  # latest migrated sprint
+        if iteration:
+            json["iteration_id"] = iteration
         return json
 
     def save(self, clubhouse):
-        logging.info("Saving story '{}'".format(self.name))
         if self.story_type:
             # 0. Upload the files (so that they have an id)
             [a.save(clubhouse) for a in self.attachments]
@@ -203,17 +309,55 @@ class Story(Issue):
             if self.subtasks:
                 [s.save(clubhouse) for s in self.subtasks]
         else: # null type
-            logging.warning("--> Story '{}' of unknown type '{}' was not saved".format(self.name, self.source.fields.issuetype.name))
+            logging.warning("--> Story '{}' of unknown type '{}' was not saved".format(self.name, self.issue_type))
+
+    def schedule(self, scheduler, clubhouse, after=(), update=False, batch=None):
+        """
+        The files are uploaded first (independently of the other jobs),
+        then the story is created (or updated), then its comments and subtasks
+        :param batch: optional batch.StoryBatcher, to create the story with its comments and tasks
+        in a bulk request (in that case, the job of the story is known only when the batcher is flushed)
+        """
+        if not self.story_type:
+            logging.warning("--> Story '{}' of unknown type '{}' was not saved".format(self.name, self.issue_type))
+            return None
+        files = [scheduler.add(a.save, clubhouse) for a in self.attachments]
+        if batch and not update:
+            batch.add(self, after=list(after) + files)
+            return None
+        super().schedule(scheduler, clubhouse, after=list(after) + files, update=update)
+        for s in self.subtasks:
+            scheduler.add(s.update if update else s.save, clubhouse, after=[self.job])
+        return self.job
+
+    def export(self, writer):
+        """
+        Write the payloads of the files and of the story, with its comments and tasks (see payloads.PayloadExport).
+        The project, epic and files are referenced by their external ids
+        """
+        if not self.story_type:
+            logging.warning("--> Story '{}' of unknown type '{}' was not saved".format(self.name, self.issue_type))
+            return
+        for a in self.attachments:
+            a.export(writer)
+        refs = {"project_id": [self.project.urlbase, self.project.source.key]}
+        if self.epic:
+            refs["epic_id"] = [self.epic.urlbase, self.epic.external_id]
+        if self.attachments:
+            refs["file_ids"] = ['files', [a.source.id for a in self.attachments]]
+        writer.write(self.urlbase, self.external_id, self.json(inline=True), refs,
+                     tasks=[t.external_id for t in self.subtasks])  # journal keys of the tasks
 
 # ----------------------------------------
 # class Subtask
 # ----------------------------------------
 class Subtask(Issue):
+    __slots__ = ['parent']
     urlbase = 'tasks'
 
     def __init__(self, jira_client, jira_issue):
         super().__init__(jira_client, jira_issue)
-        self.status = Config.get("subtask_states").get(self.source.fields.status.name)
+        self.status = Config.get("subtask_states").get(self.status)
         self.description = self.name
         self.parent = None
 
@@ -223,7 +367,7 @@ class Subtask(Issue):
             "complete": self.status,
             "created_at": self.created,
             "description": self.description,
-            "external_id": self.source.key,
+            "external_id": self.key,
             "updated_at": self.updated
         }
         #if self.owners:
@@ -232,35 +376,57 @@ class Subtask(Issue):
 
     def save(self, clubhouse):
         """ Method to save a comment. May be used instead of including the jons in the item creation itself"""
+        self.target = Journal.get(self.urlbase, self.external_id)
+        if self.target:
+            return
         response = clubhouse.post(self.parent.urlbase, self.parent.target, self.urlbase, json=self.json())
         self.target = response["id"]
+        Journal.record(self.urlbase, self.external_id, self.target)
+
+    def create(self, clubhouse):
+        self.save(clubhouse)
+
+    def path(self):
+        return self.parent.urlbase, self.parent.target, self.urlbase, self.target
 
 # ----------------------------------------
 # class Attachment
 # ----------------------------------------
 class Attachment:
+    __slots__ = ['source', 'target', 'filename', 'author', 'created', 'size', 'mimeType', 'url', 'localfile', 'digest']
+
     def __init__(self, jira_attachment):
-        self.source = jira_attachment
-        self.target = None
+        self.source = jira_attachment # kept to stream the content when the attachment is saved
+        self.target = Journal.get('files', jira_attachment.id)
         self.filename = jira_attachment.filename
-        self.author = Config.get('users').get(jira_attachment.author.name)
+        self.author = jira_attachment.author.name
         self.created = jira_attachment.created
         self.size = jira_attachment.size
         self.mimeType = jira_attachment.mimeType
         self.url = jira_attachment.content
-        folder = Config.get("attachments").get('folder')
-        self.localfile = "{}/{}".format(folder, self.filename)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        with open(self.localfile, 'wb') as f:
-            f.write(jira_attachment.get())
-            f.close()
+        self.localfile = None
+        self.digest = None
+
+    def download(self):
+        """Download the file from jira (in the AttachmentStore)"""
+        with Trace.phase("attachment download"):
+            self.localfile, self.digest = AttachmentStore.download(self)
 
     def save(self, clubhouse):
         """
-        Upload a file to the server
+        Download the file, then upload it to the server (once per distinct content)
         """
-        files = {"file": (self.filename, open(self.localfile, 'rb'), self.mimeType)}
-        response = clubhouse.post('files', files=files)
-        self.target = response[0]["id"]
+        if self.target: # already uploaded by a previous run
+            return self.target
+        if not self.localfile:
+            self.download()
+        self.target = AttachmentStore.upload(clubhouse, self)
+        Journal.record('files', self.source.id, self.target)
         return self.target
+
+    def export(self, writer):
+        """Write the downloaded file (see payloads.PayloadExport)"""
+        if not self.localfile:
+            self.download()
+        writer.write('files', self.source.id, {"filename": self.filename, "mimeType": self.mimeType,
+                                               "localfile": self.localfile, "digest": self.digest})
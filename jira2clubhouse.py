@@ -1,35 +1,91 @@
 import argparse
-from jira import JIRA  # https://jira.readthedocs.io
-from clubhouse import ClubhouseClient
-from project import Project
+from migration import Migration
+from jiratools import JiraTools
+from journal import Journal
 from config import Config
 import logging
-from registry import Members, EpicStates, StoryStates
+import sys
+from registry import Lookup
+from instrument import Trace
 
-## Parse command line
-parser = argparse.ArgumentParser()
-parser.add_argument('--config', '-c', required=True)  # Config
-parser.add_argument('--log', default=logging.INFO) # log level
-parser.add_argument('--jira_server', '-j', required=True) # log level
-parser.add_argument('--jira_user', '-u', required=True) # log level
-parser.add_argument('--jira_token', '-t', required=True) # log level
-parser.add_argument('--clubhouse_token', '-k', required=True) # log level
-parser.add_argument('--project', '-p', nargs='+')
-args = parser.parse_args()
-logging.basicConfig(level=args.log)
 
-## Load the configuration file
-Config.load(args.config)
+def main(argv=None):
+    ## Parse command line
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', '-c', required=True)  # Config
+    parser.add_argument('--log', default=logging.INFO) # log level
+    parser.add_argument('--jira_server', '-j') # required unless --xml is given
+    parser.add_argument('--jira_user', '-u')
+    parser.add_argument('--jira_token', '-t')
+    parser.add_argument('--xml', '-x') # read the issues from a Jira XML export instead of the jira server
+    parser.add_argument('--clubhouse_token', '-k', required=True) # log level
+    parser.add_argument('--project', '-p', nargs='+')
+    parser.add_argument('--bulk', action='store_true') # load each project with a single query
+    parser.add_argument('--stream', type=int, default=0) # save the issues while loading the next pages (number of pages in memory)
+    parser.add_argument('--workers', '-w', type=int, default=1) # number of concurrent clubhouse requests
+    parser.add_argument('--jira_workers', type=int, default=JiraTools.workers) # number of concurrent jira requests
+    parser.add_argument('--page_size', type=int, default=JiraTools.page_size) # number of issues per jira search request
+    parser.add_argument('--batch', type=int, default=0) # create the stories by batches of this size (bulk endpoint)
+    parser.add_argument('--lookup') # file to keep the compiled user/state tables between runs
+    parser.add_argument('--lookup_ttl', type=int, default=Lookup.ttl) # validity of the lookup file (seconds)
+    parser.add_argument('--cache') # sqlite file to keep the jira responses between runs
+    parser.add_argument('--journal') # file recording the clubhouse ids of the saved objects
+    parser.add_argument('--resume', action='store_true') # skip the objects saved in the journal by a previous run
+    parser.add_argument('--delete', action='store_true') # only delete the projects (and their stories and epics) from clubhouse
+    parser.add_argument('--sync', action='store_true') # only update the issues changed since the run recorded in the journal
+    parser.add_argument('--processes', type=int, default=1) # number of projects migrated in parallel (worker processes)
+    parser.add_argument('--shard', action='store_true') # migrate the projects one after the other, each split between the processes
+    parser.add_argument('--max_requests', type=int) # max concurrent clubhouse requests of all the processes
+    parser.add_argument('--rate_limit', type=float, default=200) # max clubhouse requests per minute (0 = no limit)
+    parser.add_argument('--iterations', action='store_true') # also migrate the sprints with dates as clubhouse iterations
+    parser.add_argument('--export') # only extract the projects: write the clubhouse payloads to this file (NDJSON)
+    parser.add_argument('--replay') # only load the payloads of this file (written by --export) into clubhouse
+    parser.add_argument('--reconcile', nargs='?', const=True) # only compare the projects in clubhouse with jira (and write the differences to this json file)
+    parser.add_argument('--plan', nargs='?', const=True) # only estimate the requests and time of the migration, and recommend settings (and write them to this json file)
+    parser.add_argument('--stats', action='store_true') # log the time of each phase and the requests per endpoint
+    parser.add_argument('--trace') # file receiving the timeline of the phases and requests (Chrome trace format)
+    args = parser.parse_args(argv)
+    if not (args.xml or args.jira_server or args.replay):
+        parser.error("--jira_server or --xml is required")
+    if (args.export or args.replay) and (args.delete or args.sync):
+        parser.error("--export and --replay cannot be used with --delete or --sync")
+    if args.export and (args.replay or args.processes > 1 or args.iterations):
+        parser.error("--export cannot be used with --replay, --processes or --iterations")
+    if (args.resume or args.sync) and not args.journal:
+        parser.error("--resume and --sync require --journal")
+    if args.sync and args.xml:
+        parser.error("--sync cannot be used with --xml")
+    if args.reconcile and (args.export or args.replay or args.delete or args.sync or args.processes > 1):
+        parser.error("--reconcile cannot be used with --export, --replay, --delete, --sync or --processes")
+    if args.plan and (args.xml or args.export or args.replay or args.delete or args.sync or args.reconcile):
+        parser.error("--plan cannot be used with --xml, --export, --replay, --delete, --sync or --reconcile")
+    if args.shard and (args.processes < 2 or args.xml or args.export or args.sync or args.delete or args.stream):
+        parser.error("--shard requires --processes, and cannot be used with --xml, --export, --sync, --delete or --stream")
+    if args.stream and (args.xml or args.export or args.sync or args.bulk):
+        parser.error("--stream cannot be used with --xml, --export, --sync or --bulk")
+    logging.basicConfig(level=args.log)
 
-## Connect and initialize
-jira_client = JIRA(args.jira_server, basic_auth=(args.jira_user, args.jira_token))
-clubhouse_client = ClubhouseClient(args.clubhouse_token)
-Members.init(clubhouse_client)
-StoryStates.init(clubhouse_client)
-EpicStates.init(clubhouse_client)
+    ## Load the configuration file
+    Config.load(args.config)
 
-## Load and Save each project
-for key in args.project:
-    logging.info("Load project '{}'".format(key))
-    Project(jira_client, key).save(clubhouse_client)
+    ## Connect and initialize
+    migration = Migration(args)
+    migration.connect()
+    Lookup.ttl = args.lookup_ttl
+    if not args.delete:
+        Lookup.init(migration.clubhouse_client, args.lookup) # fails if the mapping refers to unknown clubhouse names
 
+    ## Load and Save each project
+    failed = migration.run()
+    Journal.close()
+    if args.stats:
+        logging.info("Statistics:\n{}".format("\n".join(Trace.summary())))
+    if args.trace:
+        Trace.export(args.trace)
+    if failed:
+        logging.error("Failed projects: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+from jira.resources import Issue, Watchers, Sprint
+import sqlite3
+import threading
+import json
+import time
+
+
+class JiraCache:
+    """
+    Local (sqlite) cache of the raw jira responses: issues, watchers and sprints.
+    - issues and watchers are stored with the 'updated' field of the issue, and are valid as long as
+      the issue has not been updated in jira. The issues are stored with the list of the fields they were loaded with:
+      a cached issue is valid for the queries of these fields only (the fields of its later loads are added)
+    - sprints are not versioned by jira: they are valid for 'sprint_ttl' seconds
+    The cached objects are rebuilt as jira resources, so they can be used like the objects returned by the jira client
+    """
+    sprint_ttl = 24 * 3600
+
+    def __init__(self, file):
+        self.db = sqlite3.connect(file, check_same_thread=False, timeout=60)  # timeout: file shared by worker processes
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("create table if not exists issues (key text primary key, updated text, raw text, fields text)")
+            if "fields" not in [c[1] for c in self.db.execute("pragma table_info(issues)")]:
+                # cache of a previous version: the issues were loaded with all the fields (fields is null)
+                self.db.execute("alter table issues add column fields text")
+            self.db.execute("create table if not exists watchers (key text primary key, updated text, raw text)")
+            self.db.execute("create table if not exists sprints (id text primary key, fetched real, raw text)")
+
+    def _get(self, table, key_column, key):
+        with self.lock:
+            return self.db.execute("select * from {} where {} = ?".format(table, key_column), (key,)).fetchone()
+
+    def _put(self, table, *values):
+        with self.lock, self.db:
+            self.db.execute("insert or replace into {} values ({})".format(table, ", ".join("?" * len(values))), values)
+
+    # ---- issues
+
+    def updated(self, key, fields=None):
+        """Returns the 'updated' field of the cached issue (or None, also if it was not loaded with all the given fields)"""
+        row = self._get("issues", "key", key)
+        if not row or (fields and row[3] is not None and not set(fields) <= set(json.loads(row[3]))):
+            return None
+        return row[1]
+
+    def get_issue(self, jira, key):
+        row = self._get("issues", "key", key)
+        return Issue(jira._options, jira._session, raw=json.loads(row[2])) if row else None
+
+    def put_issue(self, issue, fields=None):
+        """
+        :param fields: the fields the issue was loaded with (None: all the fields).
+        The other fields of the cached version of the issue, if it is the same, are kept
+        """
+        raw = issue.raw
+        row = self._get("issues", "key", issue.key)
+        if fields is not None and row and row[1] == issue.fields.updated:
+            raw = dict(raw, fields=dict(json.loads(row[2])["fields"], **raw["fields"]))
+            fields = None if row[3] is None else set(json.loads(row[3])) | set(fields)
+        self._put("issues", issue.key, issue.fields.updated, json.dumps(raw),
+                  None if fields is None else json.dumps(sorted(fields)))
+
+    # ---- watchers
+
+    def get_watchers(self, jira, issue):
+        row = self._get("watchers", "key", issue.key)
+        if row and row[1] == issue.fields.updated:
+            return Watchers(jira._options, jira._session, raw=json.loads(row[2]))
+        return None
+
+    def put_watchers(self, issue, watchers):
+        self._put("watchers", issue.key, issue.fields.updated, json.dumps(watchers.raw))
+
+    # ---- sprints
+
+    def get_sprint(self, jira, id):
+        row = self._get("sprints", "id", str(id))
+        if row and time.time() - row[1] < self.sprint_ttl:
+            return Sprint(jira._options, jira._session, raw=json.loads(row[2]))
+        return None
+
+    def put_sprint(self, sprint):
+        self._put("sprints", str(sprint.id), time.time(), json.dumps(sprint.raw))
+
+    def close(self):
+        self.db.close()
@@ -1,3 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
+from instrument import Trace
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import logging
+
+
 class JiraTools:
     jira_fields = ["assignee", "comment", "components",
                    "customfield_10005", "customfield_10115",
@@ -5,13 +14,46 @@ class JiraTools:
                    "issuelinks", "issuetype",
                    "reporter", "status",
                    "subtasks", "summary", "attachment",
-                   "updated", "duedate", "watches"]
+                   "updated", "duedate", "watches", "parent"]
+    # the fields needed by the epics and the subtasks (see issue.Issue): the comments, watchers,
+    # attachments, links and sprints of the subtasks, and the attachments and links of the epics, are not migrated
+    epic_fields = [f for f in jira_fields if f not in ("attachment", "issuelinks", "subtasks", "parent", "customfield_10005")]
+    subtask_fields = ["assignee", "created", "description", "duedate", "issuetype",
+                      "parent", "reporter", "status", "summary", "updated"]
+    cache = None  # optional jiracache.JiraCache
+    workers = 8  # number of concurrent jira requests
+    page_size = 50  # number of issues per search request
+    sync_margin = timedelta(minutes=5)  # subtracted from the start of the next incremental sync (see sync_time)
+    watchers = {}  # issue key -> watchers (see prefetch_watchers)
+    sprints = {}   # sprint id -> sprint (see get_sprints)
+
+    @classmethod
+    def use_cache(cls, file):
+        """Keep the jira responses in a local cache (see jiracache.JiraCache)"""
+        from jiracache import JiraCache
+        cls.cache = JiraCache(file)
+
+    @classmethod
+    def sync_time(cls, jira):
+        """
+        Start of the next incremental sync of the issues loaded now (jql format): the time of the jira server,
+        in the timezone of the jira user (jql reads the dates in this timezone), minus a margin
+        (the dates of jql have no seconds). Without jira server (xml export), the local time
+        """
+        if not hasattr(jira, 'server_info'):
+            now = datetime.now()
+        else:
+            now = datetime.strptime(jira.server_info()["serverTime"], "%Y-%m-%dT%H:%M:%S.%f%z")
+            zone = jira.myself().get("timeZone")
+            if zone:
+                now = now.astimezone(ZoneInfo(zone))
+        return (now - cls.sync_margin).strftime("%Y/%m/%d %H:%M")
 
     @classmethod
     def get_project_epics(cls, jira, project):
         """Returns the list of epics in a jira project"""
         #type_filter += "and issuetype not in ('{}')".format("','".join(excluded_types)) if excluded_types else ''
-        return cls.get_issue_list(jira, project, ["issuetype = 'Epic'"])
+        return cls.get_issue_list(jira, project, ["issuetype = 'Epic'"], cls.epic_fields)
 
     @classmethod
     def get_epic_issues(cls, jira, project=None, epic=None):
@@ -27,23 +69,177 @@ class JiraTools:
                                                       "issuetype != 'Sub-task'",])
 
     @classmethod
-    def get_issue_list(cls, jira, project=None, filters=None):
-        n = 0
-        issues = []
+    def get_issue_list(cls, jira, project=None, filters=None, fields=None):
+        """
+        Returns the issues matching the filters (and in the project, if given)
+        :param fields: the jira fields to load (default: jira_fields)
+        """
         filters = [] if not filters else filters
         filters += ["project = '{}'".format(project)] if project else []
-        while "There are more issues":
-            batch = jira.search_issues("{} order by key asc".format(" and ".join(filters)),
-                                       startAt=n, maxResults=50, fields=cls.jira_fields, expand=["watcher", "watches", "watchers"])
-            issues.extend(batch)
-            n = n + len(batch)
-            if len(batch) < 50: break
+        fields = fields or cls.jira_fields
+        if cls.cache:
+            issues = cls.get_cached_issue_list(jira, filters, fields)
+        else:
+            issues = cls.search(jira, filters, fields)
+        if "watches" in fields:
+            cls.prefetch_watchers(jira, issues)
         return issues
 
+    @classmethod
+    def get_issue_pages(cls, jira, project=None, filters=None, fields=None):
+        """
+        Same as get_issue_list(), as a generator of pages of issues:
+        the pages are loaded (with their watchers) at most 'workers' pages ahead of the page consumed
+        """
+        filters = [] if not filters else filters
+        filters += ["project = '{}'".format(project)] if project else []
+        fields = fields or cls.jira_fields
+        for page in cls.search_pages(jira, filters, ["updated"] if cls.cache else fields):
+            if cls.cache:
+                page = cls.load_cached(jira, page, fields)
+            if "watches" in fields:
+                cls.prefetch_watchers(jira, page)
+            yield page
+
+    @classmethod
+    def search(cls, jira, filters, fields):
+        return [i for page in cls.search_pages(jira, filters, fields) for i in page]
+
+    @classmethod
+    def search_pages(cls, jira, filters, fields):
+        """
+        Generator of the pages of the results of a query: the first page gives the number of results,
+        then the next pages are loaded concurrently, in order (at most 'workers' pages ahead of the page consumed).
+        The server may return fewer than page_size issues per page (e.g. jira cloud: at most 100):
+        the next pages are requested with the size of the first page
+        """
+        jql = "{} order by key asc".format(" and ".join(filters))
+        size = cls.page_size
+
+        def load(n):
+            with Trace.phase("jira search"):
+                return jira.search_issues(jql, startAt=n, maxResults=size, fields=fields,
+                                          expand=["watcher", "watches", "watchers"])
+        page = load(0)
+        yield page
+        if 0 < len(page) < min(size, page.total):
+            size = len(page)
+        offsets = iter(range(size, page.total, size))
+        n = 0
+        with ThreadPoolExecutor(cls.workers) as pool:
+            loading = deque((n, pool.submit(load, n)) for n in islice(offsets, cls.workers))
+            while loading:
+                n, future = loading.popleft()
+                page = future.result()
+                loading.extend((n, pool.submit(load, n)) for n in islice(offsets, 1))
+                yield page
+        # issues created since the first page
+        n = n + len(page)
+        while len(page) == size:
+            page = load(n)
+            n = n + len(page)
+            yield page
+
+    @staticmethod
+    def count(jira, filters):
+        """
+        Number of issues matching the filters (a query without results: maxResults=0).
+        The search is sent as is: jira.search_issues() warns when json_result is set without maxResults
+        """
+        params = {"jql": " and ".join(filters), "startAt": 0, "maxResults": 0, "fields": "key"}
+        with Trace.phase("jira count"):
+            return jira._get_json("search", params=params)["total"]
+
+    @staticmethod
+    def sample(jira, filters, fields, start, size):
+        """A page of the raw issues (json) matching the filters, from the given position"""
+        with Trace.phase("jira search"):
+            return jira.search_issues("{} order by key asc".format(" and ".join(filters)), startAt=start,
+                                      maxResults=size, fields=fields, json_result=True)["issues"]
+
+    @classmethod
+    def get_cached_issue_list(cls, jira, filters, fields):
+        """
+        Same as get_issue_list(), through the cache:
+        a first query returns only the 'updated' field of the issues, then only the issues
+        that are not in the cache (with these fields) or have been updated since are loaded from jira
+        """
+        return cls.load_cached(jira, cls.search(jira, filters, ["updated"]), fields, filters)
+
+    @classmethod
+    def load_cached(cls, jira, stamps, fields, filters=None):
+        """
+        The issues of a list of stamps (issues with only the 'updated' field), with the given fields:
+        the issues that are not in the cache with these fields or have been updated since are loaded from jira
+        (with the query of the stamps, if given and if most issues changed)
+        """
+        changed = [i.key for i in stamps if cls.cache.updated(i.key, fields) != i.fields.updated]
+        if filters and len(changed) > len(stamps) / 2:
+            loaded = cls.search(jira, filters, fields)
+        else:
+            loaded = [i for n in range(0, len(changed), 50)
+                      for i in cls.search(jira, ["key in ({})".format(",".join(changed[n:n + 50]))], fields)]
+        for i in loaded:
+            cls.cache.put_issue(i, fields)
+        loaded = {i.key: i for i in loaded}
+        return [loaded.get(i.key) or cls.cache.get_issue(jira, i.key) for i in stamps]
+
+    @classmethod
+    def get_project_index(cls, jira, project, fields=None):
+        """
+        Returns an IssueIndex of all the issues in a jira project,
+        loaded with a single paginated query (instead of one query per epic and per story),
+        and of the issues of other projects in its epics (see get_epic_children)
+        """
+        index = IssueIndex(cls.get_issue_list(jira, project, fields=fields))
+        epics = [e.key for e in index.get_project_epics()]
+        others = sum(len(issues) for epic, issues in index.by_epic.items() if epic and epic not in epics)
+        if others:
+            logging.info("Project '{}': {} stories in epics of other projects (migrated with their epic)".format(
+                project, others))
+        for issue in cls.get_epic_children(jira, project, epics, fields):
+            index.add(issue)
+        return index
+
+    @classmethod
+    def get_epic_children(cls, jira, project, epics, fields=None):
+        """
+        Returns the stories of other projects in the given epics of a project, with their subtasks:
+        they are migrated with their epic (as get_epic_issues(), whose query has no project)
+        """
+        issues = [i for n in range(0, len(epics), 50)
+                  for i in cls.get_issue_list(jira, filters=["'Epic Link' in ({})".format(",".join(epics[n:n + 50])),
+                                                             "project != '{}'".format(project)], fields=fields)]
+        parents = [i.key for i in issues if getattr(i.fields, 'subtasks', None)]
+        return issues + cls.get_subtask_list(jira, parents)
+
+    @classmethod
+    def get_shard_index(cls, jira, project, epics, stories):
+        """
+        Returns an IssueIndex of a part of a project (see shard.ProjectShard): the given epics with their stories
+        (also those of other projects, see get_epic_children), and the given stories (without epic), with their subtasks
+        """
+        issues = []
+        for n in range(0, len(epics), 50):
+            keys = ",".join(epics[n:n + 50])
+            issues += cls.get_issue_list(jira, project, ["key in ({})".format(keys)], cls.epic_fields)
+            issues += cls.get_issue_list(jira, filters=["'Epic Link' in ({})".format(keys), "issuetype != 'Sub-task'"])
+        for n in range(0, len(stories), 50):
+            issues += cls.get_issue_list(jira, project, ["key in ({})".format(",".join(stories[n:n + 50]))])
+        parents = [i.key for i in issues if getattr(i.fields, 'subtasks', None)]
+        return IssueIndex(issues + cls.get_subtask_list(jira, parents))
+
     @classmethod
     def get_subtasks(cls, jira, key):
-        return cls.get_issue_list(jira, filters=["issuetype = 'Sub-task'",
-                                                 "parent = '{}'".format(key)])
+        return cls.get_issue_list(jira, filters=["issuetype = 'Sub-task'", "parent = '{}'".format(key)],
+                                  fields=cls.subtask_fields)
+
+    @classmethod
+    def get_subtask_list(cls, jira, keys):
+        """Returns the subtasks of a list of issues (with one query per 50 issues)"""
+        return [i for n in range(0, len(keys), 50)
+                for i in cls.get_issue_list(jira, filters=["parent in ({})".format(",".join(keys[n:n + 50]))],
+                                            fields=cls.subtask_fields)]
 
 
     #@classmethod
@@ -52,6 +248,131 @@ class JiraTools:
     #                       startAt=0, maxResults=1,
     #                       fields=cls.jira_fields)[0]
 
+    @classmethod
+    def prefetch_watchers(cls, jira, issues):
+        """
+        Load the watchers of a list of issues concurrently, so that issue_watchers() does not call jira.
+        The issues without watchers (according to their 'watches' field) are not requested,
+        nor the subtasks (their watchers are not migrated)
+        """
+        todo = []
+        for i in issues:
+            if getattr(getattr(i.fields, 'issuetype', None), 'subtask', False):
+                continue
+            if cls.watch_count(i) == 0:
+                cls.watchers[i.key] = []
+            elif i.key not in cls.watchers:
+                todo.append(i)
+        with Trace.phase("watchers"), ThreadPoolExecutor(cls.workers) as pool:
+            for i, w in zip(todo, pool.map(lambda i: cls.load_watchers(jira, i), todo)):
+                cls.watchers[i.key] = w
+
+    @staticmethod
+    def watch_count(issue):
+        """Number of watchers given by the 'watches' field (or None if unknown)"""
+        watches = getattr(issue.fields, 'watches', None)
+        return getattr(watches, 'watchCount', None)
+
     @classmethod
     def issue_watchers(cls, jira, issue):
-        return jira.watchers(issue).watchers
\ No newline at end of file
+        """Returns the watchers of an issue (prefetched, or loaded now)"""
+        if issue.key in cls.watchers:
+            return cls.watchers.pop(issue.key)
+        if cls.watch_count(issue) == 0:
+            return []
+        return cls.load_watchers(jira, issue)
+
+    @classmethod
+    def load_watchers(cls, jira, issue):
+        if cls.cache:
+            watchers = cls.cache.get_watchers(jira, issue)
+            if not watchers:
+                watchers = jira.watchers(issue)
+                cls.cache.put_watchers(issue, watchers)
+            return watchers.watchers
+        return jira.watchers(issue).watchers
+
+    @classmethod
+    def get_sprints(cls, jira, ids):
+        """
+        Returns the jira sprints with the given ids, as a dict id -> sprint.
+        The sprints are loaded once per run (and kept in the cache between runs):
+        the boards with several missing sprints are listed, the other sprints are loaded concurrently
+        :param ids: dict sprint id -> board id (or None if unknown)
+        """
+        missing = [id for id in ids if id not in cls.sprints]
+        if cls.cache:
+            for id in missing:
+                sprint = cls.cache.get_sprint(jira, id)
+                if sprint:
+                    cls.sprints[id] = sprint
+            missing = [id for id in missing if id not in cls.sprints]
+        boards = {}
+        for id in missing:
+            if ids[id]:
+                boards.setdefault(ids[id], []).append(id)
+        with Trace.phase("sprints"), ThreadPoolExecutor(cls.workers) as pool:
+            for sprints in pool.map(lambda b: cls.get_board_sprints(jira, b), [b for b, l in boards.items() if len(l) > 1]):
+                for s in sprints:
+                    cls.add_sprint(s)
+            for s in pool.map(jira.sprint, [id for id in missing if id not in cls.sprints]):
+                cls.add_sprint(s)
+        return {id: cls.sprints[id] for id in ids}
+
+    @staticmethod
+    def get_board_sprints(jira, board):
+        try:
+            return jira.sprints(board, maxResults=False)
+        except Exception as e:  # e.g. no permission on the board: the sprints are loaded one by one
+            logging.warning("Could not list the sprints of board {}: {}".format(board, e))
+            return []
+
+    @classmethod
+    def add_sprint(cls, sprint):
+        cls.sprints[str(sprint.id)] = sprint
+        if cls.cache:
+            cls.cache.put_sprint(sprint)
+
+
+class IssueIndex:
+    """
+    In-memory index of the issues of a project, by epic link, by parent key and by issue type.
+    It answers the same questions as the JiraTools queries (epics, issues of an epic, subtasks)
+    so that the Epic/Story/Subtask tree can be assembled locally.
+    """
+    epic_link_field = "customfield_10005"
+
+    def __init__(self, issues=()):
+        self.by_type = {}
+        self.by_epic = {}
+        self.by_parent = {}
+        for issue in issues:
+            self.add(issue)
+
+    def add(self, issue):
+        fields = issue.fields
+        issue_type = fields.issuetype.name
+        self.by_type.setdefault(issue_type, []).append(issue)
+        if issue_type == 'Epic':
+            return
+        elif fields.issuetype.subtask:  # (the parent of a story may be its epic)
+            self.by_parent.setdefault(fields.parent.key, []).append(issue)
+        else:
+            self.by_epic.setdefault(getattr(fields, self.epic_link_field, None), []).append(issue)
+
+    def get_project_epics(self):
+        """Returns the list of epics"""
+        return self.by_type.get('Epic', [])
+
+    def get_epic_issues(self, epic=None):
+        """
+        Returns the list of issues in an epic.
+        If the epic is None, returns the issues without an epic
+        """
+        return self.by_epic.get(epic, [])
+
+    def get_subtasks(self, key):
+        return self.by_parent.get(key, [])
+
+    def __len__(self):
+        return sum(len(issues) for issues in self.by_type.values())
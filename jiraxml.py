@@ -0,0 +1,174 @@
+from jiratools import IssueIndex
+from email.utils import parsedate_to_datetime
+from types import SimpleNamespace
+import xml.etree.ElementTree as ET
+import mimetypes
+import logging
+
+
+class JiraXmlExport:
+    """
+    Offline replacement of the jira client, reading a Jira XML/RSS search export
+    (Issues > Export > XML, e.g. SearchRequest.xml).
+    The file is parsed incrementally: the <item> elements are converted one by one into objects
+    that have the same attributes as the jira resources used by issue.py, and dropped from the tree.
+
+    Limitations of the export format:
+    - watchers are not exported (only their number): issues have no followers
+    - attachments are only described: they can be downloaded only if a live jira client is given
+    - the descriptions and comments are exported as rendered HTML (not as wiki markup)
+    """
+    epic_name_field = "customfield_10002"
+
+    def __init__(self, file, jira=None):
+        """
+        :param file: path of the XML export
+        :param jira: optional jira client (JIRA object), used to download the attachments
+        """
+        self.file = file
+        self.jira = jira
+        self.projects = {}
+        self.sprints = {}
+
+    # ---- jira client interface (the part used by project.py and issue.py)
+
+    def project(self, key):
+        return self.projects[key]
+
+    def sprint(self, id):
+        return self.sprints[id]
+
+    def watchers(self, issue):
+        return SimpleNamespace(watchers=[])
+
+    # ---- loading
+
+    def get_project_index(self, project):
+        """
+        Returns a jiratools.IssueIndex of the issues of a project.
+        The epic links of the export contain the name of the epics: they are replaced by the epic keys
+        """
+        index = IssueIndex(self.issues(project))
+        epics = {getattr(e.fields, self.epic_name_field): e.key for e in index.get_project_epics()}
+        by_epic = index.by_epic
+        index.by_epic = {}
+        for name, issues in by_epic.items():
+            key = epics.get(name)
+            if name and not key:
+                logging.warning("Epic '{}' not found in project {}".format(name, project))
+            for i in issues:
+                setattr(i.fields, IssueIndex.epic_link_field, key)
+            index.by_epic.setdefault(key, []).extend(issues)
+        return index
+
+    def issues(self, project=None):
+        """Iterate over the issues in the export (optionally only those of a project)"""
+        channel = None
+        for event, elem in ET.iterparse(self.file, events=("start", "end")):
+            if event == "start":
+                if elem.tag == "channel":
+                    channel = elem
+            elif elem.tag == "item":
+                if not project or elem.find("project").get("key") == project:
+                    yield self.parse_item(elem)
+                channel.remove(elem)
+
+    # ---- conversion of the xml elements
+
+    def parse_item(self, item):
+        project = item.find("project")
+        if project.get("key") not in self.projects:
+            self.projects[project.get("key")] = SimpleNamespace(key=project.get("key"), name=name(project),
+                                                                description="", lead=None)
+        customfields = {cf.get("id"): cf for cf in item.iter("customfield")}
+        server = text(item.find("link")).split("/browse/")[0]
+        parent = item.find("parent")
+        fields = SimpleNamespace(
+            summary=name(item.find("summary")),
+            created=date(item.find("created")),
+            updated=date(item.find("updated")),
+            duedate=date(item.find("due")),
+            description=text(item.find("description")) or None,
+            assignee=user(item.find("assignee").get("username")),
+            reporter=user(item.find("reporter").get("username")),
+            issuetype=SimpleNamespace(name=name(item.find("type")), subtask=parent is not None),
+            status=SimpleNamespace(name=name(item.find("status"))),
+            components=[SimpleNamespace(name=name(c)) for c in item.iter("component")],
+            comment=SimpleNamespace(comments=[SimpleNamespace(id=c.get("id"), author=user(c.get("author")),
+                                                              created=date(c.get("created")), body=text(c))
+                                              for c in item.iter("comment")]),
+            attachment=[XmlAttachment(self, server, a) for a in item.iter("attachment")] if self.jira else [],
+            subtasks=[SimpleNamespace(key=text(s)) for s in item.iter("subtask")],
+            parent=SimpleNamespace(key=text(parent)) if parent is not None else None,
+            issuelinks=list(self.parse_links(item)),
+            customfield_10005=self.customfield_value(customfields.get("customfield_10005")),
+            customfield_10115=self.parse_sprints(customfields.get("customfield_10115")),
+        )
+        setattr(fields, self.epic_name_field, self.customfield_value(customfields.get(self.epic_name_field)))
+        return SimpleNamespace(key=text(item.find("key")), fields=fields)
+
+    def parse_links(self, item):
+        for link_type in item.iter("issuelinktype"):
+            jira_type = SimpleNamespace(name=name(link_type.find("name")))
+            for key in link_type.findall("outwardlinks/issuelink/issuekey"):
+                yield SimpleNamespace(type=jira_type, outwardIssue=SimpleNamespace(key=text(key)))
+            for key in link_type.findall("inwardlinks/issuelink/issuekey"):
+                yield SimpleNamespace(type=jira_type, inwardIssue=SimpleNamespace(key=text(key)))
+
+    def parse_sprints(self, customfield):
+        """
+        Collect the sprints (id and name) and return them in the format of the jira API
+        (a list of strings '...[id=<id>,name=<name>,...]')
+        """
+        if customfield is None:
+            return None
+        sprints = []
+        for value in customfield.iter("customfieldvalue"):
+            if value.get("id") not in self.sprints:
+                self.sprints[value.get("id")] = SimpleNamespace(id=value.get("id"), name=name(value))
+            sprints.append("[id={},name={}]".format(value.get("id"), name(value)))
+        return sprints
+
+    @staticmethod
+    def customfield_value(customfield):
+        return name(customfield.find("customfieldvalues/customfieldvalue")) if customfield is not None else None
+
+
+class XmlAttachment:
+    """Attachment of an exported issue, streamed from the jira server on demand"""
+    def __init__(self, export, server, element):
+        self.export = export
+        self.id = element.get("id")
+        self.filename = element.get("name")
+        self.size = int(element.get("size"))
+        self.author = user(element.get("author"))
+        self.created = date(element.get("created"))
+        self.mimeType = mimetypes.guess_type(self.filename)[0] or "application/octet-stream"
+        self.content = "{}/rest/api/2/attachment/content/{}".format(server, self.id)
+
+    def iter_content(self, chunk_size=1024):
+        return self.export.jira._session.get(self.content, stream=True).iter_content(chunk_size)
+
+
+def text(element):
+    """Stripped text of an xml element (or None)"""
+    if element is None or element.text is None:
+        return None
+    return element.text.strip()
+
+
+def name(element):
+    """Text of a single-line xml element, with the line breaks of the export removed (or None)"""
+    value = text(element)
+    return " ".join(value.split()) if value is not None else None
+
+
+def date(value):
+    """Convert an RFC 822 date of the export (element or string) into the ISO format of the jira API"""
+    value = text(value) if isinstance(value, ET.Element) or value is None else value
+    return parsedate_to_datetime(value).isoformat() if value else None
+
+
+def user(username):
+    """Jira user in the format of the API (or None for 'Unassigned')"""
+    return SimpleNamespace(key=username, name=username) if username and username != "-1" else None
@@ -0,0 +1,58 @@
+import threading
+import logging
+import json
+import os
+
+
+class Journal:
+    """
+    Checkpoint journal of the objects created in clubhouse: for each kind of object (= its urlbase)
+    and each external id, the clubhouse id returned when the object was saved.
+    The journal is an append-only file of json lines, written (and flushed) after each creation,
+    so that an interrupted migration can be resumed without re-creating what was already saved.
+    Like Config, it is accessed as a class (global) - when no file is opened, nothing is recorded.
+    """
+    file = None
+    entries = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def open(cls, filename, resume=False):
+        """
+        Open the journal file.
+        :param resume: if True, load the entries of the previous run. Otherwise, start a new journal
+        """
+        cls.entries = {}
+        line = ""
+        if resume and os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                        cls.entries[(e["kind"], e["key"])] = e["id"]
+                    except ValueError:
+                        logging.warning("Ignoring incomplete journal entry: {}".format(line))
+            logging.info("Resuming from {} journal entries".format(len(cls.entries)))
+        cls.file = open(filename, 'a' if resume else 'w')
+        if cls.file.tell() > 0 and not line.endswith("\n"):
+            cls.file.write("\n") # terminate the incomplete entry of an interrupted run
+
+    @classmethod
+    def get(cls, kind, key):
+        """Returns the clubhouse id of an object saved in a previous run (or None)"""
+        return cls.entries.get((kind, key))
+
+    @classmethod
+    def record(cls, kind, key, id):
+        if not cls.file:
+            return
+        with cls.lock:
+            cls.entries[(kind, key)] = id
+            cls.file.write(json.dumps({"kind": kind, "key": key, "id": id}) + "\n")
+            cls.file.flush()
+
+    @classmethod
+    def close(cls):
+        if cls.file:
+            cls.file.close()
+            cls.file = None
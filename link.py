@@ -1,70 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+from journal import Journal
+from instrument import Trace
+import threading
 import logging
 
 class Link:
     """
     Class to store links between issues.
-    It will dynamically resolve references in ako "lazy" manner
+    The ends of a link are jira keys: the issues may be in different projects. The links are not saved
+    with their project, they are queued in the LinkQueue and saved once all the projects of the run are saved
     """
+    __slots__ = ['subject', 'object', 'link_type', 'target_id']
     urlbase = "story-links"
+    symmetric = {"relates to"}  # verbs for which 'A verb B' is the same link as 'B verb A'
 
-    def __init__(self, from_issue, to_issue, link_type):
+    def __init__(self, subject, object, link_type):
         """
-        The origin or the destination of the link must be an Issue object.
-        The other end may be a string key identifying the issue.
-        The object will try to resolve the links (replace keys with objects) only when accessed.
-        => if one of the ends is a string, it may not be accessed BEFORE the other one is loaded in the project
-        :param from_issue: the origin of the link (a string or an Issue)
-        :param to_issue:  the desintation of the link (a string of an Issue)
-        :param link_type:  the type of the link (a string)
+        :param subject: the jira key of the origin of the link
+        :param object: the jira key of the destination of the link
+        :param link_type: the clubhouse verb of the link (a string)
         """
-        self.origin= from_issue
-        self.destination = to_issue
+        if link_type in self.symmetric:
+            subject, object = sorted([subject, object])
+        self.subject = subject
+        self.object = object
         self.link_type = link_type
         self.target_id = None
 
-    @property
-    def subject(self):
-        """
-        Returns the source Issue of the link
-        Optionally resolves the link (replace the key with the referenced issue)
-        :return: a issue.Issue object (Story or Epic)
-        """
-        from issue import Issue
-        if isinstance(self.origin, Issue):
-            return self.origin
-        else:
-            self.origin = self.destination.project.issue_index[self.origin]
-            return self.origin
+    def __str__(self):
+        return "<Link {} {} {}>".format(self.subject, self.link_type, self.object)
 
     @property
-    def object(self):
+    def key(self):
         """
-        Returns the target Issue of the link
-        Optionally resolves the link (replace the key with the referenced issue)
-        :return: a issue.Issue object (Story or Epic)
+        Key of the link in the journal. The jira link is listed by both of its issues (as an outward and
+        an inward link), which give the same key
         """
-        from issue import Issue
-        if isinstance(self.destination, Issue):
-            return self.destination
-        else:
-            try:
-                self.destination= self.origin.project.issue_index[self.destination]
-                return self.destination
-            except:
-                return None # target does not exist in the project
+        return "JIRA_{} {} JIRA_{}".format(self.subject, self.link_type, self.object)
 
     def json(self):
-        json = {
-            "object_id": self.object.target,
-            "subject_id": self.subject.target,
+        return {
+            "object_id": LinkQueue.id(self.object),
+            "subject_id": LinkQueue.id(self.subject),
             "verb": self.link_type
         }
-        return json if json["object_id"] and json["subject_id"] else None
 
     def save(self, clubhouse):
-        if self.object and self.subject and self.object.target and self.subject.target:
-            response = clubhouse.post(self.urlbase, json=self.json())
-            self.target_id = response["id"]
+        json = self.json()
+        if not (json["object_id"] and json["subject_id"]):
+            logging.warning("Link between '{}' and '{}' not saved".format(self.subject, self.object))
+            return
+        self.target_id = Journal.get(self.urlbase, self.key)
+        if self.target_id:
+            return
+        response = clubhouse.post(self.urlbase, json=json)
+        self.target_id = response["id"]
+        Journal.record(self.urlbase, self.key, self.target_id)
+
+    def export(self, writer):
+        """Write the payload of the link, referencing its stories by their external ids (see payloads.PayloadExport)"""
+        ends = ["JIRA_{}".format(k) for k in (self.subject, self.object)]
+        if all(e in writer.stories or Journal.get('stories', e) for e in ends):
+            writer.write(self.urlbase, self.key, {"verb": self.link_type},
+                         {"subject_id": ['stories', ends[0]], "object_id": ['stories', ends[1]]})
         else:
-            logging.warning("Link between '{}' and '{}' not saved".format(self.origin, self.destination))
+            logging.warning("Link between '{}' and '{}' not saved".format(self.subject, self.object))
+
+
+class LinkQueue:
+    """
+    Links of all the projects of a run, saved once all the projects are saved (see save()):
+    - the index of the stories of the run (jira key -> clubhouse id) resolves the links across projects;
+      the stories saved by a previous run are found in the journal
+    - the links are de-duplicated by their key (a jira link is listed by both of its issues)
+    - the links are saved concurrently
+    Like Journal, it is accessed as a class (global). The worker processes send their queue to the main process
+    (see drain() and merge())
+    """
+    links = {}  # key -> Link
+    ids = {}    # jira key -> clubhouse id of the story
+    lock = threading.Lock()
 
+    @classmethod
+    def add_project(cls, project):
+        """Queue the links of the stories of a saved project, and index the stories"""
+        cls.add_stories(project.issue_index.values())
+
+    @classmethod
+    def add_stories(cls, stories):
+        """Queue the links of saved stories, and index the stories"""
+        with cls.lock:
+            for s in stories:
+                if s.target:
+                    cls.ids[s.key] = s.target
+                for l in s.links:
+                    cls.links.setdefault(l.key, l)
+
+    @classmethod
+    def id(cls, key):
+        return cls.ids.get(key) or Journal.get('stories', "JIRA_{}".format(key))
+
+    @classmethod
+    def drain(cls):
+        """Returns the queue (to be merged in another process) and resets it"""
+        with cls.lock:
+            data = ([(l.subject, l.object, l.link_type) for l in cls.links.values()], cls.ids)
+            cls.links, cls.ids = {}, {}
+        return data
+
+    @classmethod
+    def merge(cls, data):
+        """Add the queue drained in another process"""
+        links, ids = data
+        with cls.lock:
+            cls.ids.update(ids)
+            for l in links:
+                link = Link(*l)
+                cls.links.setdefault(link.key, link)
+
+    @classmethod
+    def pop(cls):
+        """Returns the queued links, and empties the queue"""
+        with cls.lock:
+            links = list(cls.links.values())
+            cls.links = {}
+        return links
+
+    @classmethod
+    def save(cls, clubhouse, workers=1):
+        """
+        Save the queued links
+        :return: the number of links that could not be saved
+        """
+        links = cls.pop()
+        logging.info("Saving {} links".format(len(links)))
+
+        def save(link):
+            try:
+                with Trace.phase("Link.save"):
+                    link.save(clubhouse)
+                return True
+            except Exception as e:
+                logging.error("{} failed: {}".format(link, e))
+                return False
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(save, links)).count(False)
@@ -0,0 +1,243 @@
+from jira import JIRA  # https://jira.readthedocs.io
+from transport import PooledClient
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from project import Project
+from sync import ProjectSync
+from stream import ProjectStream
+from shard import ShardedProject, ProjectShard
+from jiratools import JiraTools
+from jiraxml import JiraXmlExport
+from journal import Journal
+from teardown import Workspace
+from registry import Lookup
+from instrument import Trace, TracedClient
+from payloads import PayloadExport, PayloadReplay
+from link import LinkQueue
+from reconcile import Reconciliation
+from plan import MigrationPlan
+from config import Config
+import multiprocessing
+import logging
+import time
+
+
+class Migration:
+    """
+    A migration run, set up from the command line arguments:
+    the jira and clubhouse clients, and the migration of each project
+    (in this process, or in a pool of worker processes - see run())
+    """
+    shards_per_process = 4  # number of shards of a project per worker process (see shard())
+    def __init__(self, args):
+        self.args = args
+        self.jira_client = None
+        self.clubhouse_client = None
+        self.export = None  # payloads.PayloadExport (extraction only)
+
+    def connect(self, resume=False, semaphore=None):
+        """
+        Open the journal and create the clients
+        :param resume: load the journal even if the command line does not resume (in the workers)
+        :param semaphore: optional semaphore limiting the number of concurrent clubhouse requests
+        """
+        args = self.args
+        # Open the journal (before loading the projects: saved attachments are not downloaded again)
+        if args.journal:
+            Journal.open(args.journal, resume or args.resume or args.sync)
+        jira_client = JIRA(args.jira_server, basic_auth=(args.jira_user, args.jira_token)) if args.jira_server else None
+        if args.trace or args.stats:
+            Trace.enable()
+            if jira_client:
+                Trace.hook(jira_client._session)
+        JiraTools.workers = args.jira_workers
+        JiraTools.page_size = args.page_size
+        Project.iterations = args.iterations
+        Workspace.workers = args.workers
+        if args.cache and not args.xml:
+            JiraTools.use_cache(args.cache)
+        if args.xml:
+            # the jira server (if any) is only used to download the attachments
+            jira_client = JiraXmlExport(args.xml, jira_client)
+        self.jira_client = jira_client
+        # the request budget of the workspace is shared by the worker processes
+        rate = args.rate_limit / 60 / (args.processes if semaphore else 1)
+        self.clubhouse_client = PooledClient(args.clubhouse_token, args.workers, rate)
+        if Trace.enabled:
+            self.clubhouse_client = TracedClient(self.clubhouse_client)
+        if semaphore:
+            self.clubhouse_client = LimitedClient(self.clubhouse_client, semaphore)
+        if args.export:
+            self.export = PayloadExport(args.export)
+
+    def load_project(self, key):
+        """Load a project from jira (the index of the jira issues is released once the project is built)"""
+        logging.info("Load project '{}'".format(key))
+        with Trace.phase("extract", key):
+            if self.args.xml:
+                index = self.jira_client.get_project_index(key)
+            else:
+                index = JiraTools.get_project_index(self.jira_client, key) if self.args.bulk else None
+            return Project(self.jira_client, key, index)
+
+    def migrate(self, key):
+        """Migrate (or delete, or sync) one project"""
+        args = self.args
+        if args.delete:
+            Workspace.delete_project(self.clubhouse_client, key)
+        elif args.export:
+            self.load_project(key).export(self.export, args.jira_workers)
+        elif args.sync and Journal.get('sync', key):
+            logging.info("Sync project '{}' since {}".format(key, Journal.get('sync', key)))
+            ProjectSync(self.jira_client, key, Journal.get('sync', key)).save(self.clubhouse_client, args.workers, args.batch)
+        elif args.stream:
+            logging.info("Stream project '{}'".format(key))
+            ProjectStream(self.jira_client, key, args.stream).save(self.clubhouse_client, args.workers, args.batch)
+        else:
+            self.load_project(key).save(self.clubhouse_client, args.workers, args.batch)
+
+    def run(self):
+        """
+        Migrate all the projects of the command line (or export them, replay an export, or reconcile them).
+        With several processes, each project is migrated by a worker process with its own clients;
+        the lookup tables are copied from this process, and a semaphore shared by all the workers
+        limits the total number of concurrent clubhouse requests. The trace and the links of each worker are merged
+        in this process, which saves the links of all the projects at the end.
+        With --shard, the projects are migrated one after the other, each by all the worker processes (see shard()).
+        :return: the list of the projects that failed
+        """
+        args = self.args
+        if args.replay:
+            PayloadReplay(self.clubhouse_client, args.workers, args.batch).run(args.replay)
+            return []
+        if args.reconcile:
+            return Reconciliation(self.jira_client, self.clubhouse_client).run(
+                args.project, args.reconcile if args.reconcile is not True else None)
+        if args.plan:
+            return MigrationPlan(self.jira_client, self.clubhouse_client, args).run(
+                args.project, args.plan if args.plan is not True else None)
+        if args.processes <= 1:
+            for key in args.project:
+                self.migrate(key)
+            if self.export:
+                self.export.close()
+            return self.save_links([])
+        failed = []
+        if args.journal:  # append to the file, as the workers (this process may write while they run)
+            Journal.close()
+            Journal.open(args.journal, resume=True)
+        semaphore = multiprocessing.BoundedSemaphore(args.max_requests or args.processes * args.workers)
+        with ProcessPoolExecutor(args.processes, initializer=init_worker,
+                                 initargs=(args, Config.dict, Lookup.tables, semaphore)) as pool:
+            if args.shard:
+                for key in args.project:
+                    failed += self.shard(pool, key)
+            else:
+                failed = self.wait({pool.submit(migrate_in_worker, key): (key, "Project '{}'".format(key))
+                                    for key in args.project})
+        if args.journal:  # load the entries of the workers
+            Journal.close()
+            Journal.open(args.journal, resume=True)
+        return self.save_links(failed)
+
+    def shard(self, pool, key):
+        """
+        Migrate a project with all the worker processes (see shard.ShardedProject): this process creates the project,
+        then the shards (parts of the project) are loaded and saved by the workers
+        :return: [key] if a shard failed
+        """
+        logging.info("Shard project '{}'".format(key))
+        project = ShardedProject(self.jira_client, key)
+        project.create(self.clubhouse_client)
+        iterations = project.create_iterations(self.clubhouse_client, self.args.workers)
+        shards = project.shards(self.args.processes * self.shards_per_process)
+        futures = {pool.submit(migrate_shard_in_worker, key, project.target, epics, stories, iterations):
+                   (key, "Project '{}' shard {} ({} epics, {} stories)".format(key, n + 1, len(epics), len(stories)))
+                   for n, (epics, stories) in enumerate(shards)}
+        failed = self.wait(futures)
+        if not failed:
+            project.saved()
+        return failed
+
+    @staticmethod
+    def wait(futures):
+        """
+        Wait for the tasks submitted to the worker processes, and merge their trace and links
+        :param futures: future -> (project key, description of the task)
+        :return: the projects that failed
+        """
+        failed = []
+        for n, future in enumerate(as_completed(futures), 1):
+            key, name = futures[future]
+            try:
+                seconds, trace, links = future.result()
+                Trace.merge(trace)
+                LinkQueue.merge(links)
+                logging.info("[{}/{}] {} done in {:.0f}s".format(n, len(futures), name, seconds))
+            except Exception as e:
+                logging.error("[{}/{}] {} failed: {}: {}".format(n, len(futures), name, type(e).__name__, e))
+                if key not in failed:
+                    failed.append(key)
+        return failed
+
+    def save_links(self, failed):
+        """
+        Save the links of all the projects, once they are all saved (see link.LinkQueue)
+        :param failed: the projects that failed
+        :return: the projects that failed (and 'links' if links could not be saved)
+        """
+        if self.args.delete or self.export:
+            return failed
+        if LinkQueue.save(self.clubhouse_client, self.args.workers):
+            failed = failed + ['links']
+        return failed
+
+
+class LimitedClient:
+    """Wrapper of the clubhouse client: each request must acquire the semaphore"""
+    def __init__(self, client, semaphore):
+        self.client = client
+        self.semaphore = semaphore
+
+    def get(self, *args, **kwargs):
+        with self.semaphore:
+            return self.client.get(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        with self.semaphore:
+            return self.client.post(*args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        with self.semaphore:
+            return self.client.put(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with self.semaphore:
+            return self.client.delete(*args, **kwargs)
+
+
+# ---- worker processes
+
+worker = None  # Migration of the worker process
+
+
+def init_worker(args, config, tables, semaphore):
+    global worker
+    logging.basicConfig(level=args.log, format="%(processName)s %(levelname)s %(message)s")
+    Config.dict = config
+    Lookup.tables = tables
+    worker = Migration(args)
+    worker.connect(resume=True, semaphore=semaphore) # the journal was created by the main process
+
+
+def migrate_in_worker(key):
+    start = time.time()
+    worker.migrate(key)
+    return time.time() - start, Trace.drain(), LinkQueue.drain()
+
+
+def migrate_shard_in_worker(key, target, epics, stories, iterations):
+    start = time.time()
+    with Trace.phase("extract", key):
+        shard = ProjectShard(worker.jira_client, key, target, epics, stories, iterations)
+    shard.save(worker.clubhouse_client, worker.args.workers, worker.args.batch)
+    return time.time() - start, Trace.drain(), LinkQueue.drain()
@@ -0,0 +1,175 @@
+from scheduler import Scheduler
+from attachments import AttachmentStore
+from teardown import Workspace
+from journal import Journal
+from batch import StoryBatch
+from link import LinkQueue
+from types import SimpleNamespace
+import logging
+import json
+
+
+class PayloadExport:
+    """
+    NDJSON file of the clubhouse payloads of a migration, written by the export() methods of the projects,
+    issues and links without calling clubhouse (see PayloadReplay to load it later).
+    Each line is a record {"kind", "external_id", "json", "refs"}:
+    - kind is the clubhouse urlbase of the object (projects, files, epics, stories, story-links)
+    - json is the payload, without the ids of the other objects: refs gives, for each of these fields,
+      the kind and external id(s) of the referenced records (e.g. "epic_id": ["epics", "JIRA_OP-1"])
+    - the records are written in the order of their dependencies: a record only refers to previous records
+    The comments and tasks of a story are included in its payload. The files are the downloaded attachments.
+    The user and state ids are resolved when the file is written: they must exist in the target workspace.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+        self.records = 0
+        self.stories = set()  # external ids of the exported stories
+
+    def write(self, kind, external_id, payload, refs=None, **extra):
+        """Write a record. The fields of the payload given in refs are removed"""
+        refs = refs or {}
+        record = {"kind": kind, "external_id": external_id,
+                  "json": {k: v for k, v in payload.items() if k not in refs}, "refs": refs}
+        record.update(extra)
+        self.file.write(json.dumps(record) + "\n")
+        self.records += 1
+        if kind == 'stories':
+            self.stories.add(external_id)
+
+    def close(self):
+        """Write the queued links of all the exported projects (see link.LinkQueue), and close the file"""
+        for link in LinkQueue.pop():
+            link.export(self)
+        self.file.close()
+        logging.info("Exported {} records".format(self.records))
+
+
+class PayloadReplay:
+    """
+    Loads a PayloadExport file into clubhouse. The file is streamed: each record is scheduled on a
+    scheduler.Scheduler as soon as it is read, to run after the records it refers to
+    (the stories are created by batches with the bulk endpoint if a batch size is given: the pending batch
+    is scheduled before a record that refers to one of its stories, e.g. a link).
+    As in a migration, the target projects and epics are deleted first, and the created objects are recorded
+    in the journal: an interrupted replay can be resumed, and the projects can be synced later.
+    """
+    def __init__(self, clubhouse, workers=1, batch_size=0):
+        self.clubhouse = clubhouse
+        self.workers = workers
+        self.batch_size = batch_size
+        self.jobs = {}  # (kind, external id) -> job saving the record
+        self.ids = {}   # (kind, external id) -> clubhouse id
+        self.batch = {}  # external id -> record of the stories waiting for their batch
+        self.loaded = {}  # project key -> time of the extraction
+
+    def run(self, filename):
+        with Scheduler(self.workers) as scheduler:
+            with open(filename) as f:
+                for line in f:
+                    self.add(scheduler, json.loads(line))
+            self.flush(scheduler)
+            scheduler.wait()
+        for key, loaded_at in self.loaded.items():
+            Journal.record('sync', key, loaded_at)
+
+    def add(self, scheduler, record):
+        key = (record["kind"], record["external_id"])
+        if record["kind"] == 'projects':
+            self.loaded[record["external_id"]] = record["loaded_at"]
+        if record["kind"] == 'stories' and self.batch_size:
+            self.batch[record["external_id"]] = record
+            if len(self.batch) >= self.batch_size:
+                self.flush(scheduler)
+        else:
+            if any(kind == 'stories' and k in self.batch for kind, k in self.references(record)):
+                self.flush(scheduler)  # e.g. a link to a story of the batch: the batch is its dependency
+            self.jobs[key] = scheduler.add(self.save, record, after=list(self.dependencies(record)))
+
+    def flush(self, scheduler):
+        """Schedule the batch of stories"""
+        if not self.batch:
+            return
+        records = list(self.batch.values())
+        after = list(dict.fromkeys(j for r in records for j in self.dependencies(r)))
+        job = scheduler.add(self.save_batch, records, after=after)
+        for r in records:
+            self.jobs[(r["kind"], r["external_id"])] = job
+        self.batch = {}
+
+    @staticmethod
+    def references(record):
+        """(kind, external id) of the records referenced by a record"""
+        for kind, keys in record["refs"].values():
+            for key in keys if isinstance(keys, list) else [keys]:
+                yield kind, key
+
+    def dependencies(self, record):
+        """Jobs of the records referenced by a record"""
+        for ref in self.references(record):
+            if ref in self.jobs:
+                yield self.jobs[ref]
+
+    def resolve(self, record):
+        """The payload of a record, with the clubhouse ids of the records it refers to"""
+        payload = dict(record["json"])
+        for field, (kind, keys) in record["refs"].items():
+            if isinstance(keys, list):
+                payload[field] = list(dict.fromkeys(self.id(kind, k) for k in keys))  # same content => same file
+            else:
+                payload[field] = self.id(kind, keys)
+        return payload
+
+    def id(self, kind, key):
+        id = self.ids.get((kind, key)) or Journal.get(kind, key)
+        if not id:
+            raise ValueError("Reference to {} '{}', which is not saved".format(kind, key))
+        return id
+
+    def save(self, record):
+        kind, key = record["kind"], record["external_id"]
+        id = Journal.get(kind, key)
+        if not id: # not saved by a previous run
+            if kind == 'projects':
+                Workspace.delete_project(self.clubhouse, key)
+            elif kind == 'epics':
+                Workspace.delete_epic(self.clubhouse, key)
+            if kind == 'files':
+                id = AttachmentStore.upload(self.clubhouse, SimpleNamespace(**record["json"]))
+            else:
+                logging.info("Saving {} '{}'".format(kind, key))
+                response = self.clubhouse.post(kind, json=self.resolve(record))
+                id = response["id"]
+                if kind == 'stories':
+                    self.saved_content(record, response)
+            Journal.record(kind, key, id)
+        self.ids[(kind, key)] = id
+
+    def save_batch(self, records):
+        todo = []
+        for r in records:
+            id = Journal.get('stories', r["external_id"])
+            if id:
+                self.ids[('stories', r["external_id"])] = id
+            else:
+                todo.append(r)
+        if not todo:
+            return
+        logging.info("Saving {} stories ({} ... {})".format(len(todo), todo[0]["external_id"], todo[-1]["external_id"]))
+        response = self.clubhouse.post('stories', 'bulk', json={"stories": [self.resolve(r) for r in todo]})
+        index = {r["external_id"]: r for r in todo}
+        for story in response:
+            record = index[story["external_id"]]
+            self.ids[('stories', record["external_id"])] = story["id"]
+            Journal.record('stories', record["external_id"], story["id"])
+            self.saved_content(record, story)
+
+    @staticmethod
+    def saved_content(record, response):
+        """Record in the journal the ids of the comments and tasks created with a story"""
+        payload = record["json"]
+        for comment, id in StoryBatch.match(payload.get("comments", []), lambda c: c["external_id"], response, "comments"):
+            Journal.record('comments', comment["external_id"], id)
+        tasks = dict(zip([t["external_id"] for t in payload.get("tasks", [])], record.get("tasks", [])))
+        for task, id in StoryBatch.match(payload.get("tasks", []), lambda t: t["external_id"], response, "tasks"):
+            Journal.record('tasks', tasks[task["external_id"]], id)
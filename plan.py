@@ -0,0 +1,292 @@
+from jiratools import JiraTools
+from config import Config
+from concurrent.futures import ThreadPoolExecutor
+import statistics
+import itertools
+import logging
+import json
+import math
+import time
+
+
+class MigrationPlan:
+    """
+    Pre-flight estimate of a migration, from cheap jira queries (the issues of the projects are not loaded):
+    - the number of issues of each project, by issue type, by epic, and of subtasks (count-only queries: maxResults=0)
+    - the average number of comments, attachments (and their size), links, subtasks and watchers of the stories:
+      jira does not count them, they are measured on a few pages spread over the stories of the project
+    - the latency of jira (the first count queries) and of clubhouse (the listing of the projects)
+    The numbers of jira and clubhouse requests, the bytes transferred and the wall time of the migration are
+    estimated for the settings of the command line (see estimate()), and for the other settings of parallelism,
+    batch and loading mode: the fastest settings (with the fewest processes and workers) are recommended.
+    Not estimated: the transfer time of the attachments (bandwidth), the iterations, and the deletion of the
+    projects already in clubhouse (they are reported).
+    """
+    sample_pages = 4  # number of pages of stories sampled per project
+    choices = {
+        "mode": ["default", "bulk", "stream", "shard"],
+        "processes": [1, 2, 4, 8],
+        "workers": [1, 2, 4, 8, 16, 32],
+        "batch": [0, 50],
+    }
+    stream_pages = 4  # --stream of the recommendation
+    tolerance = (0.05, 60)  # settings within 5% (or 60 seconds) of the fastest are equivalent: the fewest processes and workers win
+
+    def __init__(self, jira_client, clubhouse, args):
+        self.jira_client = jira_client
+        self.clubhouse = clubhouse
+        self.args = args
+        self.projects = {}  # key -> counts and sample of the project (see load())
+        self.epic_sizes = {}  # key -> number of issues of each epic of the project
+        self.timings = []  # seconds of the jira count queries sent one at a time (the latency of jira)
+        self.latency = {}
+
+    def run(self, keys, filename=None):
+        """
+        Count the projects, log the estimates and the recommended settings, and write them to the file if given
+        :return: [] (nothing is migrated)
+        """
+        start = time.time()
+        existing = self.clubhouse_projects()
+        for key in keys:
+            logging.info("Count project '{}'".format(key))
+            self.projects[key] = self.load(key)
+            self.projects[key]["exists"] = key in existing
+        self.latency["jira"] = statistics.median(self.timings) if self.timings else 0
+        current = self.settings()
+        estimate = self.estimate(current)
+        recommended = self.recommend()
+        report = {
+            "latency": self.latency,
+            "projects": {key: dict(p, estimate=estimate["projects"][key]) for key, p in self.projects.items()},
+            "settings": current,
+            "estimate": estimate["total"],
+            "recommended": {"settings": recommended, "arguments": self.arguments(recommended),
+                            "estimate": self.estimate(recommended)["total"]},
+            "seconds": round(time.time() - start, 1),
+        }
+        self.log(report)
+        if filename:
+            with open(filename, "w") as f:
+                json.dump(report, f, indent=2)
+        return []
+
+    def clubhouse_projects(self):
+        """The external ids of the projects of the workspace, and the latency of clubhouse"""
+        start = time.time()
+        projects = self.clubhouse.get('projects')
+        self.latency["clubhouse"] = time.time() - start
+        return {p.get('external_id') for p in projects}
+
+    def count(self, filters):
+        """Count the issues matching the filters, and time the query"""
+        start = time.time()
+        total = JiraTools.count(self.jira_client, filters)
+        self.timings.append(time.time() - start)
+        return total
+
+    def load(self, key):
+        """The counts of the issues of a project, and the averages of a sample of its stories"""
+        project = ["project = '{}'".format(key)]
+        stories = ["issuetype != 'Epic'", "issuetype != 'Sub-task'"] + project
+        types = list(dict.fromkeys(list(Config.get('story_types')) + ['Epic', 'Sub-task']))
+        total, story_count = self.count(project), self.count(stories)
+        epics = [i.key for i in JiraTools.search(self.jira_client, ["issuetype = 'Epic'"] + project, ["issuetype"])]
+        with ThreadPoolExecutor(JiraTools.workers) as pool:
+            queries = [["'Epic Link' is EMPTY"] + stories]
+            queries += [["issuetype = '{}'".format(t)] + project for t in types]
+            queries += [["'Epic Link' = '{}'".format(e)] for e in epics]
+            counts = list(pool.map(lambda filters: JiraTools.count(self.jira_client, filters), queries))
+            no_epic = counts[0]
+            by_type = dict(zip(types, counts[1:1 + len(types)]))
+            self.epic_sizes[key] = dict(zip(epics, counts[1 + len(types):]))
+            # pages of stories spread over the project
+            size = JiraTools.page_size
+            offsets = sorted({story_count * n // self.sample_pages for n in range(self.sample_pages)})
+            pages = pool.map(lambda n: JiraTools.sample(self.jira_client, stories, JiraTools.jira_fields, n, size), offsets)
+            sample = list({i["key"]: i for page in pages for i in page}.values())
+        story_types = Config.get('story_types')
+        largest = sorted(self.epic_sizes[key].items(), key=lambda e: -e[1])
+        return {
+            "issues": total,
+            "types": by_type,
+            "epics": len(epics),
+            "stories": story_count,
+            "no_epic": no_epic,
+            "subtasks": by_type['Sub-task'],
+            "migrated": sum(n for t, n in by_type.items() if story_types.get(t)),
+            "largest_epics": largest[:5],
+            "sample": self.measure(sample),
+        }
+
+    @staticmethod
+    def measure(issues):
+        """The averages of a sample of stories (raw json)"""
+        link_types = Config.get('link_types')
+        count = len(issues) or 1
+        comments = [c for i in issues for c in (i["fields"].get("comment") or {}).get("comments", [])]
+        attachments = [a for i in issues for a in i["fields"].get("attachment") or []]
+        links = [l for i in issues for l in i["fields"].get("issuelinks") or [] if link_types.get(l["type"]["name"])]
+        watched = [i for i in issues if (i["fields"].get("watches") or {}).get("watchCount") != 0]
+        payload = sum(len(json.dumps([i["fields"].get("summary"), i["fields"].get("description")])) for i in issues)
+        payload += sum(len(json.dumps(c.get("body"))) for c in comments)
+        return {
+            "stories": len(issues),
+            "comments": len(comments) / count,
+            "attachments": len(attachments) / count,
+            "attachment_bytes": sum(a.get("size", 0) for a in attachments) / (len(attachments) or 1),
+            "links": len(links) / count,
+            "with_subtasks": len([i for i in issues if i["fields"].get("subtasks")]) / count,
+            "watched": len(watched) / count,
+            "jira_bytes": sum(len(json.dumps(i)) for i in issues) / count,
+            "payload_bytes": payload / count,
+        }
+
+    def settings(self, **changes):
+        """The settings of the command line (with the given changes)"""
+        args = self.args
+        settings = {
+            "mode": "shard" if args.shard else "stream" if args.stream else "bulk" if args.bulk else "default",
+            "processes": args.processes,
+            "workers": args.workers,
+            "jira_workers": args.jira_workers,
+            "batch": args.batch,
+            "page_size": args.page_size,
+            "rate_limit": args.rate_limit,
+            "max_requests": args.max_requests,
+        }
+        settings.update(changes)
+        return settings
+
+    def estimate(self, settings):
+        """
+        The requests, bytes and wall time of the migration with the given settings:
+        the projects are migrated in parallel by the processes (or one after the other, each by all the processes
+        with --shard), then the links are saved; all the processes share the clubhouse rate limit
+        """
+        projects = {key: self.estimate_project(p, self.epic_sizes[key], settings) for key, p in self.projects.items()}
+        total = {k: sum(p[k] for p in projects.values())
+                 for k in ["jira_requests", "clubhouse_requests", "jira_bytes", "clubhouse_bytes"]}
+        seconds = [p["seconds"] for p in projects.values()]
+        if settings["mode"] == "shard" or settings["processes"] <= 1:
+            elapsed = sum(seconds)
+        else:
+            elapsed = max(sum(seconds) / settings["processes"], max(seconds, default=0))
+        links = sum(p["links"] for p in projects.values())
+        elapsed += self.clubhouse_seconds(links, 0, settings["workers"], settings["rate_limit"])
+        total["clubhouse_requests"] += links
+        if settings["rate_limit"]:
+            elapsed = max(elapsed, total["clubhouse_requests"] / (settings["rate_limit"] / 60))
+        total["seconds"] = round(elapsed)
+        total = {k: round(v) for k, v in total.items()}
+        return {"projects": projects, "total": total}
+
+    def estimate_project(self, p, epic_sizes, settings):
+        """The requests, bytes and wall time of the migration of a project (links excepted, see estimate())"""
+        sample = p["sample"]
+        mode = settings["mode"]
+
+        def pages(n):
+            return math.ceil(n / settings["page_size"])
+        parents = p["stories"] * sample["with_subtasks"]
+        # jira: the searches, the watchers, and the attachments (downloaded by the clubhouse workers)
+        if mode == "default":  # one query per epic and per story with subtasks, one after the other
+            searches = pages(p["epics"]) + pages(p["no_epic"]) + sum(max(1, pages(n)) for n in epic_sizes.values())
+            searches += parents
+        elif mode == "bulk":
+            searches = pages(p["issues"])
+        else:  # pages of epics and stories, with the subtasks of 50 stories per query
+            searches = pages(p["epics"]) + pages(p["stories"]) + math.ceil(parents / 50)
+            if mode == "shard":  # and the listing of the epic links
+                searches += pages(p["epics"]) + pages(p["stories"])
+        watchers = (p["epics"] + p["stories"]) * sample["watched"]
+        files = p["migrated"] * sample["attachments"]
+        processes = settings["processes"] if mode == "shard" else 1
+        jira_workers = settings["jira_workers"] * processes
+        latency = self.latency["jira"]
+        if mode == "default":
+            jira_seconds = searches * latency + watchers * latency / jira_workers
+        else:
+            jira_seconds = (searches + watchers) * latency / jira_workers
+        # clubhouse: the project, epics, files, stories, comments and tasks
+        if settings["batch"]:
+            stories = math.ceil(p["migrated"] / settings["batch"])
+        else:
+            stories = p["migrated"] * (1 + sample["comments"])
+            stories += p["subtasks"] * p["migrated"] / (p["stories"] or 1)
+        requests = 1 + p["epics"] + files + stories
+        workers = settings["workers"] * processes
+        if settings["max_requests"]:
+            workers = min(workers, settings["max_requests"] if mode == "shard"
+                          else max(1, settings["max_requests"] // settings["processes"]))
+        rate = settings["rate_limit"] * processes / settings["processes"]
+        clubhouse_seconds = self.clubhouse_seconds(requests, files * latency, workers, rate)
+        attachments = files * sample["attachment_bytes"]
+        return {
+            "jira_requests": round(1 + searches + watchers + files),
+            "clubhouse_requests": round(requests),
+            "links": round(p["migrated"] * sample["links"] / 2),  # a link is listed by both of its stories
+            "jira_bytes": round(p["issues"] * sample["jira_bytes"] + attachments),
+            "clubhouse_bytes": round(p["migrated"] * sample["payload_bytes"] + attachments),
+            "seconds": round(max(jira_seconds, clubhouse_seconds) if mode == "stream"
+                             else jira_seconds + clubhouse_seconds, 1),
+        }
+
+    def clubhouse_seconds(self, requests, downloads, workers, rate_limit):
+        """
+        Time of clubhouse requests sent by concurrent workers, under the rate limit (requests per minute)
+        :param downloads: seconds of jira requests done by the same workers
+        """
+        seconds = (requests * self.latency["clubhouse"] + downloads) / workers
+        return max(seconds, requests / (rate_limit / 60)) if rate_limit else seconds
+
+    def recommend(self):
+        """The fastest settings (within the tolerance, the settings with the fewest processes and workers)"""
+        candidates = []
+        for mode, processes, workers, batch in itertools.product(*self.choices.values()):
+            if mode == "shard" and processes < 2 or mode != "shard" and processes > max(1, len(self.projects)):
+                continue  # --shard requires several processes, a process per project otherwise
+            settings = self.settings(mode=mode, processes=processes, workers=workers, batch=batch, max_requests=None)
+            candidates.append((self.estimate(settings)["total"], settings))
+        fastest = min(estimate["seconds"] for estimate, settings in candidates)
+        limit = max(fastest * (1 + self.tolerance[0]), fastest + self.tolerance[1])
+        return min(((e, s) for e, s in candidates if e["seconds"] <= limit),
+                   key=lambda c: (c[1]["processes"], c[1]["workers"], c[0]["seconds"], c[0]["clubhouse_requests"]))[1]
+
+    def arguments(self, settings):
+        """The command line options of the settings"""
+        args = ["--workers {}".format(settings["workers"])]
+        if settings["processes"] > 1:
+            args.append("--processes {}".format(settings["processes"]))
+        if settings["batch"]:
+            args.append("--batch {}".format(settings["batch"]))
+        args += {"bulk": ["--bulk"], "stream": ["--stream {}".format(self.stream_pages)], "shard": ["--shard"]}.get(
+            settings["mode"], [])
+        return " ".join(args)
+
+    def log(self, report):
+        logging.info("Latency: jira {:.3f}s, clubhouse {:.3f}s".format(report["latency"]["jira"],
+                                                                     report["latency"]["clubhouse"]))
+        for key, p in report["projects"].items():
+            sample = p["sample"]
+            logging.info("Project '{}': {} issues ({} epics, {} stories, {} migrated, {} subtasks, {} without epic){}"
+                         .format(key, p["issues"], p["epics"], p["stories"], p["migrated"], p["subtasks"],
+                                 p["no_epic"], " - already in clubhouse (deleted by the migration)" if p["exists"] else ""))
+            logging.info("  per story: {:.1f} comments, {:.2f} attachments ({:.0f} KB), {:.2f} links, "
+                         "{:.0%} with subtasks, {:.0%} watched ({} stories sampled)"
+                         .format(sample["comments"], sample["attachments"], sample["attachment_bytes"] / 1024,
+                                 sample["links"], sample["with_subtasks"], sample["watched"], sample["stories"]))
+            if p["largest_epics"]:
+                logging.info("  largest epics: {}".format(", ".join("{} ({})".format(*e) for e in p["largest_epics"])))
+            logging.info("  {}".format(self.describe(p["estimate"])))
+        logging.info("Estimate with the current settings ({}): {}".format(
+            self.arguments(report["settings"]), self.describe(report["estimate"])))
+        recommended = report["recommended"]
+        logging.info("Recommended settings: {}: {}".format(recommended["arguments"], self.describe(recommended["estimate"])))
+
+    @staticmethod
+    def describe(estimate):
+        return "{} jira requests ({:.1f} MB), {} clubhouse requests ({:.1f} MB), {}".format(
+            estimate["jira_requests"], estimate["jira_bytes"] / 2 ** 20,
+            estimate["clubhouse_requests"], estimate["clubhouse_bytes"] / 2 ** 20,
+            time.strftime("%H:%M:%S", time.gmtime(estimate["seconds"])))
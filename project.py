@@ -1,29 +1,55 @@
 from config import Config
 from jiratools import JiraTools
 from issue import Epic, Story
-from registry import Members
+from registry import Lookup, MappingError
+from scheduler import Scheduler
+from batch import StoryBatcher
+from journal import Journal
+from teardown import Workspace
+from link import LinkQueue
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 class Project:
     urlbase = 'projects'
+    update = False  # update the issues saved by a previous run (see sync.ProjectSync)
+    delete_epics = True  # delete the epics of a previous run before creating them (see shard.ProjectShard)
+    iterations = False  # also save the sprints with dates as clubhouse iterations
 
-    def __init__(self, jira_client, key):
+    def __init__(self, jira_client, key, index=None):
+        """
+        :param index: optional jiratools.IssueIndex with all the issues of the project.
+        If given, the epic/story/subtask tree is built from the index instead of querying jira per epic and story
+        """
+        self.batch_size = 0
+        self.loaded_at = JiraTools.sync_time(jira_client) # (jql format) start of the next incremental sync
         self.source = jira_client.project(key)
         self.target = None
         self.name = self.source.name
 
         self.sprints = {}
         self.description = self.source.description
-        self.owner = Config.get('users').get(self.source.lead.name)
+        self.owner = Config.get('users').get(self.source.lead.name) if self.source.lead else None
+        self.load_issues(jira_client, index)
+
+    def load_issues(self, jira_client, index=None):
+        """Build the tree of the epics, stories and subtasks of the project"""
+        if index is not None:
+            epics = index.get_project_epics()
+            no_epics = index.get_epic_issues(None)
+        else:
+            epics = JiraTools.get_project_epics(jira_client, self.source.key)
+            no_epics = JiraTools.get_epic_issues(jira_client, self.source.key, None)
         # Get all epics in project (and collect the issues in each epic)
-        self.epics = [Epic(jira_client,e) for e in JiraTools.get_project_epics(jira_client, self.source.key)]
+        self.epics = [Epic(jira_client, e, index) for e in epics]
         # Also collect the issues without an epic
-        self.no_epics = [Story(jira_client, s) for s in JiraTools.get_epic_issues(jira_client, self.source.key, None)]
+        self.no_epics = [Story(jira_client, s, index) for s in no_epics]
         # setup links to self in the children
         for s in self.no_epics + self.epics:
             s.project = self
-        self.issue_index = {s.source.key: s for s in self.no_epics}
-        self.issue_index.update({s.source.key: s for e in self.epics for s in e.stories})
+        self.issue_index = {s.key: s for s in self.no_epics}
+        self.issue_index.update({s.key: s for e in self.epics for s in e.stories})
+        self.load_sprints(jira_client, self.epics + list(self.issue_index.values()))
 
     def __str__(self):
         return "<Project {} '{}'>".format(self.source.key, self.name)
@@ -36,62 +62,151 @@ class Project:
         }
         return json
 
-    def save(self, clubhouse):
+    def check(self):
+        """Check that all the users and statuses of the issues can be resolved, before saving anything"""
+        self.check_issues(self.epics, self.issue_index.values())
+
+    def check_issues(self, epics, issues):
+        stories = [s for s in issues if s.story_type]
+        missing = Lookup.check({
+            'users': {u for i in epics + stories for u in i.users()},
+            'epic_states': {e.status for e in epics},
+            'issue_states': {s.status for s in stories},
+        })
+        if missing:
+            raise MappingError("Unmapped jira names in project {}:\n{}".format(self.source.key, "\n".join(missing)))
+
+    def create(self, clubhouse):
+        self.target = Journal.get(self.urlbase, self.source.key)
+        if self.target:
+            logging.info("Resuming target project #{}".format(self.target))
+            return
         self.delete(clubhouse)
         logging.info("Saving target project '{}'".format(self.name))
         response = clubhouse.post(self.urlbase, json=self.json())
         self.target = response['id']
-        logging.info("Saving epics")
+        Journal.record(self.urlbase, self.source.key, self.target)
+
+    def save(self, clubhouse, workers=1, batch_size=0):
+        """
+        Save the project and all its content.
+        The calls are run by a scheduler.Scheduler with the given number of workers:
+        the epics are independent, the stories wait for their epic and the project,
+        the comments and tasks wait for their story. The links are queued (see link.LinkQueue)
+        :param batch_size: if not 0, create the stories (with their comments and tasks) by batches of this size
+        """
+        self.batch_size = batch_size
+        self.check()
+        with Scheduler(workers) as scheduler:
+            self.schedule(scheduler, clubhouse)
+            scheduler.wait()
+        self.saved()
+
+    def saved(self):
+        """Called once the project is saved: queue its links, and record the time of its extraction (see sync.py)"""
+        LinkQueue.add_project(self)  # the links are saved once all the projects are saved
+        Journal.record('sync', self.source.key, self.loaded_at)
+
+    def export(self, writer, workers=1):
+        """
+        Write the payloads of the project and of its content (see payloads.PayloadExport), without calling clubhouse.
+        The attachments are downloaded first, concurrently
+        """
+        self.check()
+        stories = [s for s in self.issue_index.values() if s.story_type]
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda a: a.download(), [a for s in stories for a in s.attachments]))
+        writer.write(self.urlbase, self.source.key, self.json(), loaded_at=self.loaded_at)
+        for e in self.epics:
+            e.export(writer)
+        for s in self.no_epics:
+            s.export(writer)
+        LinkQueue.add_project(self)  # the links are written once all the projects are exported
+
+    def schedule(self, scheduler, clubhouse):
+        # the iterations are created first (the stories refer to them)
+        iterations = self.schedule_iterations(scheduler, clubhouse, self.sprints.values())
+        project = scheduler.add(self.create, clubhouse, after=iterations)
+        self.schedule_issues(scheduler, clubhouse, project)
+        return project
+
+    def schedule_issues(self, scheduler, clubhouse, project):
+        batch = StoryBatcher(scheduler, clubhouse, self.batch_size) if self.batch_size else None
         for e in self.epics:
-            e.save(clubhouse)
-        logging.info("Saving stories without epics")
+            e.schedule(scheduler, clubhouse, after=[project], update=self.update, batch=batch)
         for s in self.no_epics:
-            s.save(clubhouse)
-        # save all links (must be done after all stories are saved)
-        logging.info("Saving links")
-        [l.save(clubhouse) for key,s in self.issue_index.items() for l in s.links]
+            s.schedule(scheduler, clubhouse, after=[project], update=self.update, batch=batch)
+        if batch:
+            batch.flush()
 
-        logging.info("Saving sprints")
-        for key, s in self.sprints.items():
-            s.save(clubhouse)
+    def schedule_iterations(self, scheduler, clubhouse, sprints):
+        """Schedule the creation of the iterations of the sprints (see Sprint), if enabled"""
+        if not self.iterations:
+            return []
+        for s in sprints:
+            if s.start and s.end and not s.job:
+                s.job = scheduler.add(s.create, clubhouse)
+        return [s.job for s in sprints if s.job]
 
     def delete(self, clubhouse):
-        """Deletes a project and the stories it contains"""
-        # TO DO: delete epics as well
-        projects = clubhouse.get(self.urlbase)
-        the_project = next((p for p in projects if p['external_id'] == self.source.key), None)
-        if the_project:
-            logging.info("Deleting target project #{}".format(the_project['id']))
-            stories = clubhouse.get(self.urlbase, the_project['id'], 'stories')
-            for s in stories:
-                clubhouse.delete(Story.urlbase, s['id'])
-            clubhouse.delete(self.urlbase, the_project['id'])
-
-    def add_to_sprints(self, issue, sprint_ids):
-        # TODO: refactor this code - it is not very elegant
-        sprint_objects = []
-        for id in sprint_ids:
-            if id in self.sprints:
-                sprint = self.sprints[id]
-            else:
-                sprint = Sprint(issue.jira_client,id)
-                self.sprints[id] = sprint
-            sprint.add_issue(issue)
-            sprint_objects.append(sprint)
-        issue.sprints = sprint_objects
+        """Deletes a project, the stories it contains and its epics"""
+        Workspace.delete_project(clubhouse, self.source.key)
+
+    def load_sprints(self, jira_client, issues):
+        """
+        Replace the sprint ids of the issues by Sprint objects, shared by the issues:
+        the missing sprints of all the issues are loaded at once (see JiraTools.get_sprints)
+        :return: the sprints that were not used by the issues loaded before
+        """
+        ids = {}
+        for i in issues:
+            ids.update(i.sprints)
+        missing = {id: board for id, board in ids.items() if id not in self.sprints}
+        for id, jira_sprint in JiraTools.get_sprints(jira_client, missing).items():
+            self.sprints[id] = Sprint.get(jira_sprint)
+        for i in issues:
+            i.sprints = [self.sprints[id] for id, board in i.sprints]
+        return [self.sprints[id] for id in missing]
+
 
 class Sprint:
-    def __init__(self, jira_client, id):
-        jira_sprint = jira_client.sprint(id)
-        self.source = jira_sprint
+    """
+    A jira sprint. It is saved as a label of its issues (computed once per sprint) and, if Project.iterations
+    is set and the sprint has dates, as a clubhouse iteration (the stories are added to their latest iteration).
+    The sprints are shared by the projects of the process, so that an iteration is created once.
+    Note: two worker processes migrating projects of the same board may both create its iterations
+    """
+    __slots__ = ['id', 'name', 'start', 'end', 'label', 'target', 'job']
+    urlbase = 'iterations'
+    index = {}  # sprint id -> Sprint
+
+    def __init__(self, jira_sprint):
+        self.id = str(jira_sprint.id)
         self.name = jira_sprint.name
-        self.issues = []
+        self.start = (getattr(jira_sprint, 'startDate', None) or "")[:10]  # iso date
+        self.end = (getattr(jira_sprint, 'endDate', None) or "")[:10]
+        self.label = {"name": "Sprint: {}".format(self.name)}
+        self.target = Journal.get(self.urlbase, self.id)
+        self.job = None  # scheduler job creating the iteration (see Project.schedule_iterations())
 
-    def add_issue(self, issue):
-        self.issues.append(issue)
+    @classmethod
+    def get(cls, jira_sprint):
+        id = str(jira_sprint.id)
+        if id not in cls.index:
+            cls.index[id] = Sprint(jira_sprint)
+        return cls.index[id]
 
-    def save(self, clubhouse):
-        """Sprints are saved as labels (not as interations).
-        Reason: Jira sprints are not required to have start/end dates - but Clubhouse iterations do.
-        => no save procedure, the sprint info is saved in the Issue.save() method"""
-        pass
+    def json(self):
+        return {
+            "name": self.name,
+            "start_date": self.start,
+            "end_date": self.end,
+        }
+
+    def create(self, clubhouse):
+        if self.target:
+            return
+        logging.info("Saving iteration '{}'".format(self.name))
+        response = clubhouse.post(self.urlbase, json=self.json())
+        self.target = response['id']
+        Journal.record(self.urlbase, self.id, self.target)
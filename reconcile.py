@@ -0,0 +1,175 @@
+from project import Project
+from jiratools import JiraTools
+from teardown import Workspace
+from link import Link
+from instrument import Trace
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import hashlib
+import logging
+import json
+
+
+class Reconciliation:
+    """
+    Comparison of migrated projects with jira, to check that every issue, comment, subtask, link and attachment
+    arrived. Both sides are listed in bulk (no request per issue):
+    - jira: the paginated query of all the issues of the project, without the watchers
+    - clubhouse: the projects and epics of the workspace (see teardown.Workspace), and the stories of each project
+    Each entity is normalized to the clubhouse fields given by the mapping of Issue.json() / Story.json(),
+    with the clubhouse ids of the epic and project replaced by their external ids, and the comments, tasks and
+    files replaced by their number (the attachments with the same content are one file: see count_files());
+    the entities are then compared by external id and by digest:
+    - missing: in jira, not in clubhouse
+    - extra: in clubhouse (with the external id prefix of the project), not in jira
+    - divergent: different digests (with the values of the fields that differ)
+    The story links are compared once all the projects are listed (links to other projects of the run are included).
+    Not compared: the descriptions, dates and followers, the comments of the epics,
+    and the links to the projects that are not reconciled.
+    """
+    fields = {
+        'projects': ["name"],
+        'epics': ["name", "epic_state_id", "owner_ids", "requested_by_id", "deadline", "labels"],
+        'stories': ["name", "story_type", "workflow_state_id", "owner_ids", "requested_by_id", "deadline", "labels",
+                    "epic", "project", "comments", "tasks", "files"],
+    }
+    jira_fields = [f for f in JiraTools.jira_fields if f != "watches"]  # the watchers are loaded one issue at a time
+    examples = 10  # number of differences logged per kind (all of them are in the report)
+
+    def __init__(self, jira_client, clubhouse):
+        self.jira_client = jira_client
+        self.clubhouse = clubhouse
+        self.report = {}  # project key (or 'links') -> kind -> {"missing": [], "extra": [], "divergent": {}}
+        self.links = {}  # the links of jira: key -> external ids of the stories
+        self.story_links = set()  # the links of clubhouse: (subject id, object id, verb)
+        self.stories = (set(), {})  # the stories of jira (external ids) and clubhouse (id -> external id)
+
+    def run(self, keys, filename=None):
+        """
+        Reconcile the projects, and write the report (json) to the file if given
+        :return: the projects with differences (and 'links' if the links differ)
+        """
+        Workspace.init(self.clubhouse, reload=True)
+        for key in keys:
+            self.report[key] = self.reconcile(key)
+        # the links between stories listed on both sides
+        listed = self.stories[0] & set(self.stories[1].values())
+        source = {k: {} for k, ends in self.links.items() if all(e in listed for e in ends)}
+        target = {}
+        for subject, object, verb in self.story_links:
+            ends = [self.stories[1].get(subject), self.stories[1].get(object)]
+            if all(e in listed for e in ends):
+                target[Link(ends[0][5:], ends[1][5:], verb).key] = {}
+        self.report['links'] = {'story-links': self.compare(source, target)}
+        if filename:
+            with open(filename, "w") as f:
+                json.dump(self.report, f, indent=2)
+        failed = []
+        for key, kinds in self.report.items():
+            for kind, result in kinds.items():
+                self.log(key, kind, result)
+            if any(result["missing"] or result["extra"] or result["divergent"] for result in kinds.values()):
+                failed.append(key)
+        return failed
+
+    def reconcile(self, key):
+        logging.info("Reconcile project '{}'".format(key))
+        with Trace.phase("reconcile", key), ThreadPoolExecutor(1) as pool:
+            target = pool.submit(self.load_target, key)  # while jira is loaded
+            source = self.load_source(key)
+            target = target.result()
+        return {kind: self.compare(source[kind], target[kind]) for kind in source}
+
+    def load_source(self, key):
+        """The normalized entities of a jira project"""
+        project = Project(self.jira_client, key, JiraTools.get_project_index(self.jira_client, key, self.jira_fields))
+        project.check()
+        stories = [s for s in project.issue_index.values() if s.story_type]
+        self.stories[0].update(s.external_id for s in stories)
+        for s in stories:
+            for l in s.links:
+                self.links[l.key] = ["JIRA_{}".format(l.subject), "JIRA_{}".format(l.object)]
+        return {
+            'projects': {key: self.normalize('projects', project.json())},
+            'epics': {e.external_id: self.normalize('epics', e.json()) for e in project.epics},
+            'stories': {s.external_id: self.normalize('stories', s.json(), epic=s.epic.external_id if s.epic else None,
+                                                      project=key, comments=len(s.comments), tasks=len(s.subtasks),
+                                                      files=self.count_files(s))
+                        for s in stories},
+        }
+
+    @staticmethod
+    def count_files(story):
+        """
+        Number of clubhouse files of a story: its attachments with the same content share a file (see AttachmentStore).
+        Only the attachments of the same size may have the same content: these ones are downloaded to compare their digests
+        """
+        sizes = Counter(a.size for a in story.attachments)
+        files = set()
+        for a in story.attachments:
+            if sizes[a.size] > 1 and not a.digest:
+                a.download()
+            files.add(a.digest if sizes[a.size] > 1 else a.source.id)
+        return len(files)
+
+    def load_target(self, key):
+        """The normalized entities of a project in clubhouse"""
+        project = Workspace.projects.get(key)
+        prefix = "JIRA_{}-".format(key)
+        epics = {external_id: e for external_id, l in Workspace.epics.items() if external_id.startswith(prefix) for e in l}
+        epic_ids = {e['id']: e['external_id'] for l in Workspace.epics.values() for e in l}
+        stories = self.clubhouse.get('projects', project['id'], 'stories') if project else []
+        story_ids = {s['id']: s.get('external_id') or "#{}".format(s['id']) for s in stories}
+        self.stories[1].update(story_ids)
+        for s in stories:
+            self.story_links.update((l['subject_id'], l['object_id'], l['verb']) for l in s.get('story_links', []))
+        return {
+            'projects': {key: self.normalize('projects', project)} if project else {},
+            'epics': {external_id: self.normalize('epics', e) for external_id, e in epics.items()},
+            'stories': {story_ids[s['id']]: self.normalize('stories', s, epic=epic_ids.get(s.get('epic_id')), project=key,
+                                                           comments=len(s.get('comment_ids', [])),
+                                                           tasks=len(s.get('task_ids', [])),
+                                                           files=len(s.get('file_ids', [])))
+                        for s in stories},
+        }
+
+    @classmethod
+    def normalize(cls, kind, json, **refs):
+        """The compared values of an entity (a clubhouse payload or object, and the values computed by the caller)"""
+        values = dict(json, **refs)
+        normalized = {f: values.get(f) for f in cls.fields[kind]}
+        for f in ("owner_ids", "labels"):
+            if f in normalized:
+                normalized[f] = sorted(l["name"] if isinstance(l, dict) else l for l in normalized[f] or [])
+        if normalized.get("deadline"):
+            normalized["deadline"] = normalized["deadline"][:10]  # the date only
+        return normalized
+
+    @staticmethod
+    def digest(values):
+        return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def compare(cls, source, target):
+        divergent = {}
+        for key, values in source.items():
+            if key in target and cls.digest(values) != cls.digest(target[key]):
+                divergent[key] = {f: [v, target[key][f]] for f, v in values.items() if v != target[key][f]}
+        return {
+            "missing": sorted(k for k in source if k not in target),
+            "extra": sorted(k for k in target if k not in source),
+            "divergent": divergent,
+        }
+
+    @classmethod
+    def log(cls, key, kind, result):
+        counts = {k: len(v) for k, v in result.items()}
+        if not any(counts.values()):
+            return
+        logging.warning("{} {}: {missing} missing, {extra} extra, {divergent} divergent".format(key, kind, **counts))
+        for k in result["missing"][:cls.examples]:
+            logging.warning("  missing {}".format(k))
+        for k in result["extra"][:cls.examples]:
+            logging.warning("  extra {}".format(k))
+        for k, fields in list(result["divergent"].items())[:cls.examples]:
+            logging.warning("  divergent {}: {}".format(k, ", ".join("{} {!r} != {!r}".format(f, *v) for f, v in fields.items())))
@@ -1,3 +1,7 @@
+from config import Config
+import json
+import time
+
 class Registry():
     """
     Abstract class for representing clubhouse reference elements like: users, states, etc.
@@ -75,3 +79,90 @@ class StoryStates(Registry):
     @classmethod
     def load_source_elements(self, obj):
         return obj[0].get('states')
+
+
+class MappingError(Exception):
+    pass
+
+
+class Lookup:
+    """
+    Compiled resolution tables, joining the mapping of the configuration file with the registries:
+    for each table ('users', 'issue_states', 'epic_states'), the clubhouse id of each jira name.
+    The tables can be persisted in a file, so that the registries are not loaded again at each startup.
+    The file is used as long as it is younger than 'ttl' seconds and the mapping has not changed.
+    """
+    registries = {'users': Members, 'issue_states': StoryStates, 'epic_states': EpicStates}
+    ttl = 24 * 3600
+    tables = {}
+
+    @classmethod
+    def init(cls, clubhouse_client, file=None):
+        """Load the tables from the file if it is still valid, otherwise compile (and save) them"""
+        if file and cls.load(file):
+            return
+        for registry in cls.registries.values():
+            registry.init(clubhouse_client)
+        cls.compile()
+        if file:
+            cls.save(file)
+
+    @classmethod
+    def compile(cls):
+        """
+        Build the tables from the mapping and the registries.
+        Fails (MappingError) if a clubhouse name of the mapping does not exist in the registry
+        """
+        cls.tables = {}
+        errors = []
+        for table, registry in cls.registries.items():
+            cls.tables[table] = {}
+            for jira_name, clubhouse_name in Config.get(table).items():
+                if clubhouse_name not in registry.items:
+                    errors.append("{}: '{}' is mapped to unknown '{}'".format(table, jira_name, clubhouse_name))
+                else:
+                    cls.tables[table][jira_name] = registry.get_id(clubhouse_name)
+        if errors:
+            raise MappingError("Invalid mapping:\n" + "\n".join(errors))
+
+    @classmethod
+    def signature(cls):
+        """The part of the configuration the tables depend on"""
+        return {table: Config.get(table) for table in cls.registries}
+
+    @classmethod
+    def load(cls, file):
+        try:
+            with open(file) as f:
+                saved = json.load(f)
+        except (OSError, IOError, ValueError):
+            return False
+        if time.time() - saved["created"] > cls.ttl or saved["mapping"] != cls.signature():
+            return False
+        cls.tables = saved["tables"]
+        return True
+
+    @classmethod
+    def save(cls, file):
+        with open(file, 'w') as f:
+            json.dump({"created": time.time(), "mapping": cls.signature(), "tables": cls.tables}, f)
+
+    @classmethod
+    def get_id(cls, table, jira_name):
+        """Returns the clubhouse id of a jira name (None if the name is None)"""
+        if jira_name is None:
+            return None
+        try:
+            return cls.tables[table][jira_name]
+        except KeyError:
+            raise MappingError("{}: '{}' is not mapped".format(table, jira_name))
+
+    @classmethod
+    def check(cls, names):
+        """
+        Check that jira names can be resolved
+        :param names: dict table -> set of jira names
+        :return: the list of the names that are not mapped
+        """
+        return ["{}: '{}'".format(table, n) for table, values in names.items()
+                for n in sorted(values - set(cls.tables[table]) - {None})]
@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+from instrument import Trace
+import threading
+import logging
+
+
+class Job:
+    """
+    A call to run by the scheduler, once all the jobs it depends on are done
+    """
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.waiting = 0  # number of dependencies not done yet
+        self.next = []    # jobs waiting for this one
+        self.done = False
+        self.result = None
+
+    @property
+    def name(self):
+        """Class.method of a bound method (e.g. 'Story.create', even if the method is inherited)"""
+        if hasattr(self.function, '__self__'):
+            return "{}.{}".format(type(self.function.__self__).__name__, self.function.__name__)
+        return getattr(self.function, '__qualname__', str(self.function))
+
+    def __str__(self):
+        return "<Job {}>".format(self.name)
+
+
+class Scheduler:
+    """
+    Runs calls (typically the clubhouse 'save' of projects, epics, stories, comments, tasks and links)
+    on a bounded pool of workers, in the order of their dependencies:
+    a job is started only when all the jobs given in its 'after' list are done.
+    If a job fails, no further job is started and the error is raised by wait()
+    """
+    def __init__(self, workers=1):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0
+        self.added = 0  # number of jobs added
+        self.error = None
+
+    def add(self, function, *args, after=()):
+        """
+        Schedule function(*args) to run after the given jobs
+        :param after: list of Job (None values are ignored)
+        :return: the new Job
+        """
+        job = Job(function, args)
+        with self.lock:
+            self.pending += 1
+            self.added += 1
+            for j in after:
+                if j and not j.done:
+                    job.waiting += 1
+                    j.next.append(job)
+            ready = job.waiting == 0
+        if ready:
+            self.executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        try:
+            if not self.error:
+                with Trace.phase(job.name):
+                    job.result = job.function(*job.args)
+        except Exception as e:
+            logging.error("{} failed: {}".format(job, e))
+            with self.lock:
+                self.error = self.error or e
+        finally:
+            with self.lock:
+                job.done = True
+                ready = []
+                for j in job.next:
+                    j.waiting -= 1
+                    if j.waiting == 0:
+                        ready.append(j)
+                job.next = []  # released (the job may be kept by the objects it saved)
+                self.pending -= 1
+                self.idle.notify_all()
+            for j in ready:
+                self.executor.submit(self._run, j)
+
+    def wait(self, pending=0):
+        """
+        Wait until all the scheduled jobs are done (or until at most 'pending' jobs are not done).
+        Raise the first error if a job failed
+        """
+        with self.idle:
+            while self.pending > pending:
+                self.idle.wait()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
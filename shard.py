@@ -0,0 +1,120 @@
+from project import Project, Sprint
+from issue import Issue
+from jiratools import JiraTools, IssueIndex
+from link import LinkQueue
+from journal import Journal
+from teardown import Workspace
+from instrument import Trace
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import logging
+
+
+class ShardedProject(Project):
+    """
+    A project migrated by several worker processes (see Migration.shard()).
+    This object, in the main process, only lists the epics and the epic link of each story
+    (a light paginated query), creates the clubhouse project (and the iterations), and splits
+    the epics and the stories without epic into shards of about the same number of issues.
+    Each shard is loaded and saved by a worker process (see ProjectShard); the links of the shards are
+    saved at the end by the main process, with the links of the other projects (see link.LinkQueue).
+    """
+    unit_size = 50  # number of stories without epic per unit of work
+
+    def load_issues(self, jira_client, index=None):
+        """List the epics, and the number of stories of each epic"""
+        key = self.source.key
+        self.epics = []
+        self.no_epics = []
+        self.issue_index = {}
+        self.sizes = {}       # epic key -> number of issues (the epic and its stories)
+        self.unassigned = []  # keys of the stories without epic
+        sprints = {}
+        with Trace.phase("shard plan", key):
+            for page in JiraTools.search_pages(jira_client, ["issuetype = 'Epic'", "project = '{}'".format(key)],
+                                               ["issuetype"]):
+                self.sizes.update((i.key, 1) for i in page)
+            for page in JiraTools.search_pages(jira_client, ["issuetype != 'Epic'", "issuetype != 'Sub-task'",
+                                                             "project = '{}'".format(key)],
+                                               ["issuetype", IssueIndex.epic_link_field, "customfield_10115"]):
+                for i in page:
+                    epic = getattr(i.fields, IssueIndex.epic_link_field, None)
+                    if i.fields.issuetype.subtask or (epic and epic not in self.sizes):
+                        continue  # subtask (loaded with its parent), or story of an epic of another project (migrated with its epic)
+                    if epic:
+                        self.sizes[epic] += 1
+                    else:
+                        self.unassigned.append(i.key)
+                    sprints.update(Issue.parse_sprint(s) for s in getattr(i.fields, 'customfield_10115', None) or [])
+        if self.iterations:
+            for id, jira_sprint in JiraTools.get_sprints(jira_client, sprints).items():
+                self.sprints[id] = Sprint.get(jira_sprint)
+        logging.info("Project '{}': {} epics, {} issues".format(key, len(self.sizes), sum(self.sizes.values())
+                                                                + len(self.unassigned)))
+
+    def create(self, clubhouse):
+        """
+        Create the project, and delete the epics of a previous run: the shards do not delete them,
+        the workspace index of a worker process is not updated by the other processes (see ProjectShard)
+        """
+        super().create(clubhouse)
+        for epic in self.sizes:  # when the project is resumed (otherwise they are deleted with the project)
+            if not Journal.get('epics', "JIRA_{}".format(epic)):
+                Workspace.delete_epic(clubhouse, "JIRA_{}".format(epic))
+
+    def create_iterations(self, clubhouse, workers=1):
+        """Create the iterations of the sprints (if enabled) before the shards, which would create them several times"""
+        sprints = [s for s in self.sprints.values() if self.iterations and s.start and s.end]
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda s: s.create(clubhouse), sprints))
+        return {s.id: s.target for s in sprints}
+
+    def shards(self, count):
+        """
+        Split the epics and the stories without epic in shards of about the same number of issues
+        (the largest units first, each in the smallest shard)
+        :return: a list of (epic keys, story keys)
+        """
+        units = [(size, [epic], []) for epic, size in self.sizes.items()]
+        units += [(len(self.unassigned[n:n + self.unit_size]), [], self.unassigned[n:n + self.unit_size])
+                  for n in range(0, len(self.unassigned), self.unit_size)]
+        shards = [(0, n, [], []) for n in range(count)]
+        for size, epics, stories in sorted(units, key=lambda u: -u[0]):
+            total, n, shard_epics, shard_stories = heapq.heappop(shards)
+            heapq.heappush(shards, (total + size, n, shard_epics + epics, shard_stories + stories))
+        return [(epics, stories) for total, n, epics, stories in sorted(shards, key=lambda s: s[1]) if epics or stories]
+
+    def saved(self):
+        """The project is saved once all its shards are saved (the links are queued by the shards)"""
+        Journal.record('sync', self.source.key, self.loaded_at)
+
+
+class ProjectShard(Project):
+    """
+    A part of a project: some of its epics (with their stories) and some of its stories without epic,
+    saved by a worker process in the project created by the main process (see ShardedProject).
+    The epics of a previous run are deleted by the main process
+    """
+    delete_epics = False
+
+    def __init__(self, jira_client, key, target, epics, stories, iterations=None):
+        """
+        :param target: the clubhouse id of the project
+        :param iterations: the clubhouse ids of the iterations created by the main process (sprint id -> id)
+        """
+        self.shard = (epics, stories)
+        super().__init__(jira_client, key)
+        self.target = target
+        for s in self.sprints.values():
+            s.target = s.target or (iterations or {}).get(s.id)
+
+    def load_issues(self, jira_client, index=None):
+        epics, stories = self.shard
+        super().load_issues(jira_client, JiraTools.get_shard_index(jira_client, self.source.key, epics, stories))
+
+    def create(self, clubhouse):
+        """The project is created by the main process"""
+
+    def saved(self):
+        """The links are queued (they are saved by the main process), the project is recorded by the main process"""
+        LinkQueue.add_project(self)
@@ -0,0 +1,138 @@
+from project import Project
+from issue import Epic, Story
+from jiratools import JiraTools, IssueIndex
+from scheduler import Scheduler
+from batch import StoryBatcher
+from journal import Journal
+from link import LinkQueue
+from collections import deque
+import threading
+import logging
+import queue
+
+
+class ProjectStream(Project):
+    """
+    Pipelined migration of a project: the issues are saved while the next ones are loaded from jira,
+    instead of loading the whole tree of the project first.
+    A producer thread reads the epics, then the stories page by page (each page with the subtasks of its stories),
+    and hands the pages to the saving thread through a bounded queue; each page is transformed and scheduled
+    on the scheduler.Scheduler as soon as it is received.
+    At most 'pages' pages are queued, and the jobs of at most 'pages' pages are scheduled and not done:
+    the memory is bounded by the number of pages, not by the size of the project (only the epics, without
+    their stories, and the sprints are kept until the end).
+    Differences with Project.save():
+    - the users and statuses are checked page by page: an unmapped name stops the migration once the previous
+      pages are saved (it can be resumed with the journal)
+    - the last batch of stories of each page may be smaller than the batch size
+    """
+    def __init__(self, jira_client, key, pages=2):
+        self.jira_client = jira_client
+        self.pages = pages
+        super().__init__(jira_client, key)
+
+    def load_issues(self, jira_client, index=None):
+        """The issues are loaded while the project is saved (see save())"""
+        self.epics = []
+        self.no_epics = []
+        self.issue_index = {}
+
+    def read(self):
+        """
+        The pages of the project: (epics, None) then (stories, IssueIndex of their subtasks),
+        and last the stories of other projects in the epics of the project (see JiraTools.get_epic_children)
+        """
+        key = self.source.key
+        epics = []
+        for page in JiraTools.get_issue_pages(self.jira_client, key, ["issuetype = 'Epic'"], JiraTools.epic_fields):
+            epics += [e.key for e in page]
+            yield page, None
+        for page in JiraTools.get_issue_pages(self.jira_client, key, ["issuetype != 'Epic'", "issuetype != 'Sub-task'"]):
+            parents = [i.key for i in page if i.fields.subtasks]
+            yield page, IssueIndex(JiraTools.get_subtask_list(self.jira_client, parents) if parents else [])
+        issues = JiraTools.get_epic_children(self.jira_client, key, epics)
+        if issues:
+            yield [i for i in issues if not i.fields.issuetype.subtask], IssueIndex(issues)
+
+    def produce(self, pages, stop):
+        """Put the pages in the queue, then None (or the exception raised while loading)"""
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        try:
+            for item in self.read():
+                if not put(item):
+                    return  # the saving thread stopped
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def save(self, clubhouse, workers=1, batch_size=0):
+        self.batch_size = batch_size
+        pages = queue.Queue(self.pages)
+        stop = threading.Event()
+        producer = threading.Thread(target=self.produce, args=(pages, stop), daemon=True)
+        producer.start()
+        window = deque(maxlen=self.pages)  # number of jobs of the last pages
+        try:
+            with Scheduler(workers) as scheduler:
+                project = self.schedule(scheduler, clubhouse)
+                epics = {}
+                while True:
+                    item = pages.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    added = scheduler.added
+                    page, subtasks = item
+                    if subtasks is None:
+                        for e in self.schedule_epics(scheduler, clubhouse, project, page):
+                            epics[e.key] = e
+                    else:
+                        self.schedule_stories(scheduler, clubhouse, project, page, subtasks, epics)
+                    window.append(scheduler.added - added)
+                    scheduler.wait(sum(window))  # the previous pages are (about) done
+                scheduler.wait()
+        finally:
+            stop.set()
+            producer.join()
+        Journal.record('sync', self.source.key, self.loaded_at)
+
+    def schedule_epics(self, scheduler, clubhouse, project, page):
+        epics = [Epic(self.jira_client, e, IssueIndex()) for e in page]  # the stories are loaded later
+        for e in epics:
+            e.project = self
+        self.load_sprints(self.jira_client, epics)
+        self.check_issues(epics, [])
+        for e in epics:
+            e.schedule(scheduler, clubhouse, after=[project], update=self.update)
+        self.epics.extend(epics)
+        return epics
+
+    def schedule_stories(self, scheduler, clubhouse, project, page, subtasks, epics):
+        stories = []
+        for i in page:
+            epic = getattr(i.fields, IssueIndex.epic_link_field, None)
+            if i.fields.issuetype.subtask or (epic and epic not in epics):
+                continue  # subtask (loaded with its parent), or story of an epic of another project (migrated with its epic)
+            s = Story(self.jira_client, i, subtasks)
+            s.epic = epics.get(epic)
+            s.project = self
+            stories.append(s)
+        self.schedule_iterations(scheduler, clubhouse, self.load_sprints(self.jira_client, stories))
+        self.check_issues([], stories)
+        batch = StoryBatcher(scheduler, clubhouse, self.batch_size) if self.batch_size else None
+        for s in stories:
+            after = [project, s.epic.job if s.epic else None] + [sprint.job for sprint in s.sprints]
+            s.schedule(scheduler, clubhouse, after=after, update=self.update, batch=batch)
+        if batch:
+            batch.flush()
+        # the links are queued once the stories are saved (see link.LinkQueue)
+        scheduler.add(LinkQueue.add_stories, stories, after=[s.job for s in stories])
+        logging.info("Scheduled {} stories".format(len(stories)))
@@ -0,0 +1,74 @@
+from project import Project
+from issue import Epic, Story, Subtask
+from jiratools import JiraTools, IssueIndex
+from journal import Journal
+
+
+class SavedIssue:
+    """
+    Issue saved in clubhouse by a previous run and not updated since in jira:
+    it is not loaded from jira, its clubhouse id is read from the journal
+    """
+    job = None
+
+    def __init__(self, issue_class, key):
+        self.urlbase = issue_class.urlbase
+        self.external_id = "JIRA_{}".format(key)
+        self.target = Journal.get(self.urlbase, self.external_id)
+
+    def __str__(self):
+        return "<Saved {}>".format(self.external_id)
+
+
+class SavedIssueIndex(dict):
+    """Issue index of a project sync: the stories that were not updated are found in the journal"""
+    def __missing__(self, key):
+        issue = SavedIssue(Story, key)
+        if not issue.target:
+            raise KeyError(key)
+        return issue
+
+
+class ProjectSync(Project):
+    """
+    Incremental update of a project migrated by a previous run (see journal.Journal):
+    only the issues updated in jira since the last run are loaded, and they are updated in clubhouse
+    (or created, if they are new). Only the new comments, files, tasks and links are added.
+    Note: the issues deleted in jira are not deleted in clubhouse
+    """
+    update = True
+
+    def __init__(self, jira_client, key, since):
+        """
+        :param since: time of the last run (jql format)
+        """
+        index = IssueIndex(JiraTools.get_issue_list(jira_client, key, ["updated >= '{}'".format(since)]))
+        super().__init__(jira_client, key, index)
+        # Also collect the updated stories of epics that were not updated,
+        # and the updated subtasks of stories that were not updated
+        epics = {e.key for e in self.epics}
+        self.orphans = []
+        for epic, issues in index.by_epic.items():
+            if epic and epic not in epics:
+                for i in issues:
+                    s = Story(jira_client, i, index)
+                    s.epic = SavedIssue(Epic, epic)
+                    s.project = self
+                    self.orphans.append(s)
+        self.issue_index.update({s.key: s for s in self.orphans})
+        self.load_sprints(jira_client, self.orphans)
+        self.issue_index = SavedIssueIndex(self.issue_index)
+        self.orphan_tasks = []
+        for parent, issues in index.by_parent.items():
+            if parent not in self.issue_index:
+                for i in issues:
+                    t = Subtask(jira_client, i)
+                    t.parent = SavedIssue(Story, parent)
+                    self.orphan_tasks.append(t)
+
+    def schedule_issues(self, scheduler, clubhouse, project):
+        super().schedule_issues(scheduler, clubhouse, project)
+        for s in self.orphans:
+            s.schedule(scheduler, clubhouse, after=[project], update=True)
+        for t in self.orphan_tasks:
+            scheduler.add(t.update, clubhouse)
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from instrument import Trace
+import threading
+import logging
+
+
+class Workspace:
+    """
+    Index of the projects and epics of the clubhouse workspace by external id
+    (several epics may have the same external id, e.g. after an interrupted run).
+    It is loaded once (on first use), and used to delete the objects created by a previous migration
+    without searching them one by one:
+    - the stories of a project are deleted with the bulk endpoint
+    - the epics of a project (external id 'JIRA_<project key>-...') are deleted concurrently
+    """
+    workers = 8
+    bulk_size = 100  # max number of stories per bulk delete
+    projects = None
+    epics = None
+    lock = threading.Lock()
+
+    @classmethod
+    def init(cls, clubhouse, reload=False):
+        """:param reload: list the workspace again, even if it was already loaded"""
+        with cls.lock:
+            if cls.projects is None or reload:
+                cls.projects = {p['external_id']: p for p in clubhouse.get('projects') if p.get('external_id')}
+                cls.epics = {}
+                for e in clubhouse.get('epics'):
+                    if e.get('external_id'):
+                        cls.epics.setdefault(e['external_id'], []).append(e)
+                logging.info("Workspace: {} projects, {} epics".format(len(cls.projects), len(cls.epics)))
+
+    @classmethod
+    def delete_epic(cls, clubhouse, external_id):
+        cls.init(clubhouse)
+        with cls.lock:
+            epics = cls.epics.pop(external_id, [])
+        for e in epics:
+            clubhouse.delete('epics', e['id'])
+
+    @classmethod
+    def delete_project(cls, clubhouse, key):
+        """Deletes a project, its stories and its epics"""
+        with Trace.phase("delete project", key):
+            cls._delete_project(clubhouse, key)
+
+    @classmethod
+    def _delete_project(cls, clubhouse, key):
+        cls.init(clubhouse)
+        with cls.lock:
+            project = cls.projects.pop(key, None)
+            prefix = "JIRA_{}-".format(key)
+            epics = [e for k in [k for k in cls.epics if k.startswith(prefix)] for e in cls.epics.pop(k)]
+        with ThreadPoolExecutor(cls.workers) as pool:
+            if project:
+                logging.info("Deleting target project #{}".format(project['id']))
+                stories = [s['id'] for s in clubhouse.get('projects', project['id'], 'stories')]
+                chunks = [stories[n:n + cls.bulk_size] for n in range(0, len(stories), cls.bulk_size)]
+                list(pool.map(lambda ids: clubhouse.delete('stories', 'bulk', json={"story_ids": ids}), chunks))
+            logging.info("Deleting {} epics".format(len(epics)))
+            list(pool.map(lambda e: clubhouse.delete('epics', e['id']), epics))
+        if project:
+            clubhouse.delete('projects', project['id'])
@@ -0,0 +1,121 @@
+from jira.client import ResultList
+from jira.resources import Issue
+from types import SimpleNamespace
+from jiratools import JiraTools
+from jiracache import JiraCache
+import unittest
+
+
+class FakeJira:
+    """Jira client searching a list of issues, returning at most 'cap' issues per page (as jira cloud)"""
+    def __init__(self, count, cap=None):
+        self.issues = [SimpleNamespace(key="TEST-{}".format(n + 1)) for n in range(count)]
+        self.cap = cap
+        self.requests = 0
+
+    def search_issues(self, jql, startAt=0, maxResults=50, **kwargs):
+        self.requests += 1
+        size = min(maxResults, self.cap) if self.cap else maxResults
+        return ResultList(self.issues[startAt:startAt + size], startAt, size, len(self.issues))
+
+    def _get_json(self, path, params=None):
+        self.requests += 1
+        return {"startAt": params["startAt"], "maxResults": params["maxResults"], "total": len(self.issues),
+                "issues": self.issues[:params["maxResults"]]}
+
+
+class FieldsJira:
+    """Jira client returning the requested fields of its issues (jira resources, as the cache rebuilds them)"""
+    _options = {"server": "http://jira"}
+    _session = None
+
+    def __init__(self):
+        self.issues = [{"key": "TEST-1", "fields": {"updated": "2020-01-01", "summary": "Story", "comment": {"comments": []},
+                                                    "issuetype": {"name": "Story", "subtask": False},
+                                                    "watches": {"watchCount": 1}}},
+                       {"key": "TEST-2", "fields": {"updated": "2020-01-01", "summary": "Subtask",
+                                                    "issuetype": {"name": "Sub-task", "subtask": True},
+                                                    "watches": {"watchCount": 1}}}]
+        self.searches = []  # fields of the searches
+        self.watched = []  # keys of the issues whose watchers were requested
+
+    def search_issues(self, jql, startAt=0, maxResults=50, fields=None, **kwargs):
+        self.searches.append(fields)
+        issues = [Issue(self._options, self._session, raw={"key": i["key"], "fields": {
+            f: v for f, v in i["fields"].items() if f in fields}}) for i in self.issues[startAt:startAt + maxResults]]
+        return ResultList(issues, startAt, maxResults, len(self.issues))
+
+    def watchers(self, issue):
+        self.watched.append(issue.key)
+        return SimpleNamespace(watchers=[], raw={"watchers": []})
+
+
+class SearchPagesTest(unittest.TestCase):
+    def setUp(self):
+        self.page_size = JiraTools.page_size
+
+    def tearDown(self):
+        JiraTools.page_size = self.page_size
+
+    def search(self, jira):
+        return [i.key for i in JiraTools.search(jira, ["project = 'TEST'"], ["summary"])]
+
+    def test_pages(self):
+        jira = FakeJira(450)
+        JiraTools.page_size = 50
+        self.assertEqual(self.search(jira), [i.key for i in jira.issues])
+        self.assertEqual(jira.requests, 10)  # 9 pages, and the last (empty) page of the issues created meanwhile
+
+    def test_capped_pages(self):
+        """The server returns fewer issues than requested: no issue is skipped"""
+        jira = FakeJira(450, cap=100)
+        JiraTools.page_size = 200
+        self.assertEqual(self.search(jira), [i.key for i in jira.issues])
+
+    def test_capped_single_page(self):
+        jira = FakeJira(80, cap=100)
+        JiraTools.page_size = 200
+        self.assertEqual(self.search(jira), [i.key for i in jira.issues])
+        self.assertEqual(jira.requests, 1)
+
+
+class CachedSearchTest(unittest.TestCase):
+    def setUp(self):
+        JiraTools.cache = JiraCache(":memory:")
+
+    def tearDown(self):
+        JiraTools.cache.close()
+        JiraTools.cache = None
+        JiraTools.watchers = {}
+
+    def test_fields(self):
+        """The cache loads the requested fields, and reloads the issues cached without some of them"""
+        jira = FieldsJira()
+        issues = JiraTools.get_issue_list(jira, "TEST", fields=["summary", "updated"])
+        self.assertEqual(jira.searches, [["updated"], ["summary", "updated"]])
+        self.assertEqual([i.fields.summary for i in issues], ["Story", "Subtask"])
+        JiraTools.get_issue_list(jira, "TEST", fields=["summary", "updated"])
+        self.assertEqual(jira.searches[2:], [["updated"]])  # from the cache
+        issues = JiraTools.get_issue_list(jira, "TEST", fields=["comment", "updated"])
+        self.assertEqual(jira.searches[3:], [["updated"], ["comment", "updated"]])
+        self.assertEqual(issues[0].fields.comment.comments, [])
+        issues = JiraTools.get_issue_list(jira, "TEST", fields=["comment", "summary", "updated"])
+        self.assertEqual(jira.searches[5:], [["updated"]])  # the fields of both loads are cached
+        self.assertEqual(issues[0].fields.summary, "Story")
+
+    def test_subtask_watchers(self):
+        """The watchers of the subtasks are not prefetched"""
+        jira = FieldsJira()
+        JiraTools.get_issue_list(jira, "TEST", fields=["issuetype", "updated", "watches"])
+        self.assertEqual(jira.watched, ["TEST-1"])
+
+
+class CountTest(unittest.TestCase):
+    def test_count(self):
+        jira = FakeJira(450)
+        self.assertEqual(JiraTools.count(jira, ["project = 'TEST'"]), 450)
+        self.assertEqual(jira.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+from bench_servers import SyntheticWorkspace, JiraStandIn, ClubhouseStandIn
+from attachments import AttachmentStore
+from transport import PooledClient
+from teardown import Workspace
+from project import Sprint
+from link import LinkQueue
+from collections import Counter
+import jira2clubhouse
+import clubhouse
+import tempfile
+import unittest
+import random
+import json
+import os
+
+
+class MigrationTest(unittest.TestCase):
+    """Migrations of a synthetic workspace from the jira stand-in to the clubhouse stand-in (see bench_servers.py)"""
+    def setUp(self):
+        random.seed(0)  # the errors injected by the stand-ins
+        self.workspace = SyntheticWorkspace(projects=2, epics=3, stories=20)
+        self.jira = JiraStandIn(self.workspace)
+        self.jira.serve()
+        self.clubhouse = ClubhouseStandIn(self.workspace)
+        self.host = clubhouse.ENDPOINT_HOST
+        clubhouse.ENDPOINT_HOST = self.clubhouse.serve()
+        self.folder = tempfile.mkdtemp(prefix="test-")
+        self.config = os.path.join(self.folder, "mapping.json")
+        with open(self.config, "w") as f:
+            json.dump(SyntheticWorkspace.config(os.path.join(self.folder, "attachments")), f)
+        PooledClient.backoff = 0.01
+
+    def tearDown(self):
+        clubhouse.ENDPOINT_HOST = self.host
+        PooledClient.backoff = 1.0
+
+    def migrate(self, *options):
+        """Run jira2clubhouse, with the global state of a new process"""
+        Workspace.projects = Workspace.epics = None
+        LinkQueue.links, LinkQueue.ids = {}, {}
+        AttachmentStore.uploads = {}
+        Sprint.index = {}
+        jira2clubhouse.main(["--config", self.config, "--jira_server", self.jira.url, "--jira_user", "test",
+                             "--jira_token", "test", "--clubhouse_token", "test", "--rate_limit", "0", "--log", "ERROR",
+                             "--project", "BENCH1", "BENCH2"] + list(options))
+
+    def test_errors(self):
+        """The writes failing after they are done are retried without creating anything twice"""
+        self.clubhouse.errors = 0.2
+        self.migrate("--workers", "4", "--batch", "5")
+        self.clubhouse.errors = 0
+        self.assertGreater(sum(s["errors"] for s in self.clubhouse.stats.values()), 0)
+        stories = Counter(s["external_id"] for s in self.clubhouse.stories.values())
+        self.assertEqual(max(stories.values()), 1)
+        self.migrate("--reconcile")  # exits with an error if a story, comment, task, file or link differs
+
+    def test_processes(self):
+        """A second migration deletes the projects of the first one, also when the deletions fail after they are done"""
+        self.clubhouse.errors = 0.2
+        self.migrate("--processes", "2", "--workers", "2")
+        self.migrate("--processes", "2", "--workers", "2")
+        self.clubhouse.errors = 0
+        self.assertEqual(len(self.clubhouse.projects), 2)
+        self.migrate("--reconcile")
+
+
+if __name__ == '__main__':
+    unittest.main()
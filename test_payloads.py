@@ -0,0 +1,92 @@
+from bench_servers import SyntheticWorkspace, ClubhouseStandIn
+from payloads import PayloadExport, PayloadReplay
+from transport import PooledClient
+from teardown import Workspace
+from journal import Journal
+import clubhouse
+import tempfile
+import unittest
+import os
+
+
+class PayloadReplayTest(unittest.TestCase):
+    stories = 5
+
+    @classmethod
+    def setUpClass(cls):
+        cls.host = clubhouse.ENDPOINT_HOST
+
+    @classmethod
+    def tearDownClass(cls):
+        clubhouse.ENDPOINT_HOST = cls.host
+
+    def setUp(self):
+        self.standin = ClubhouseStandIn(SyntheticWorkspace(epics=0, stories=0))
+        clubhouse.ENDPOINT_HOST = self.standin.serve()
+        self.client = PooledClient("test")
+        self.folder = tempfile.mkdtemp(prefix="test-")
+        self.filename = os.path.join(self.folder, "export.ndjson")
+        Workspace.projects = Workspace.epics = None
+        Journal.entries = {}
+
+    def tearDown(self):
+        Journal.close()
+        Journal.entries = {}
+
+    def export(self):
+        """A project with an epic, its stories, and a link from each story to the next one"""
+        writer = PayloadExport(self.filename)
+        writer.write('projects', 'TEST', {"name": "Test", "external_id": "TEST"}, loaded_at="2020/01/01 00:00")
+        writer.write('epics', 'JIRA_TEST-1', {"name": "Epic", "external_id": "JIRA_TEST-1"})
+        keys = ["JIRA_TEST-{}".format(n + 2) for n in range(self.stories)]
+        for k in keys:
+            writer.write('stories', k, {"name": k, "external_id": k, "project_id": None, "epic_id": None},
+                         {"project_id": ['projects', 'TEST'], "epic_id": ['epics', 'JIRA_TEST-1']})
+        for k, other in zip(keys, keys[1:]):
+            writer.write('story-links', "{}/{}".format(k, other), {"verb": "relates to"},
+                         {"subject_id": ['stories', k], "object_id": ['stories', other]})
+        writer.close()
+
+    def replay(self, batch_size):
+        PayloadReplay(self.client, workers=1, batch_size=batch_size).run(self.filename)
+
+    def assertReplayed(self):
+        self.assertEqual(len(self.standin.projects), 1)
+        self.assertEqual(len(self.standin.epics), 1)
+        self.assertEqual(len(self.standin.stories), self.stories)
+        links = {l["id"]: l for s in self.standin.stories.values() for l in s["story_links"]}
+        self.assertEqual(len(links), self.stories - 1)
+
+    def test_replay(self):
+        self.export()
+        self.replay(0)
+        self.assertReplayed()
+
+    def test_partial_batch(self):
+        """The last link refers to stories of the last batch, not full yet: the batch is saved first"""
+        self.export()
+        self.replay(3)
+        self.assertReplayed()
+
+    def test_resume(self):
+        """A replay interrupted after some records is resumed from the journal: nothing is created twice"""
+        self.export()
+        journal = os.path.join(self.folder, "journal.jsonl")
+        partial = os.path.join(self.folder, "partial.ndjson")
+        with open(self.filename) as f, open(partial, "w") as p:
+            p.writelines(f.readlines()[:5])  # the project, the epic and 3 stories
+        Journal.open(journal)
+        PayloadReplay(self.client, batch_size=3).run(partial)
+        Journal.close()
+        with open(journal, "a") as f:
+            f.write('{"kind": "stories", "key": "JIRA_TE')  # interrupted while writing
+        Journal.open(journal, resume=True)
+        self.replay(3)
+        self.assertReplayed()
+        Journal.close()
+        Journal.open(journal, resume=True)
+        self.assertEqual(len([k for k in Journal.entries if k[0] == 'story-links']), self.stories - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+from reconcile import Reconciliation
+import unittest
+
+
+class FakeAttachment:
+    """Attachment whose content is known once downloaded"""
+    def __init__(self, id, size, content):
+        self.source = SimpleNamespace(id=id)
+        self.size = size
+        self.content = content
+        self.digest = None
+        self.downloads = 0
+
+    def download(self):
+        self.downloads += 1
+        self.digest = "sha-{}".format(self.content)
+
+
+class CountFilesTest(unittest.TestCase):
+    def count(self, *attachments):
+        return Reconciliation.count_files(SimpleNamespace(attachments=list(attachments)))
+
+    def test_distinct_sizes(self):
+        """Attachments of different sizes are different files, without being downloaded"""
+        attachments = [FakeAttachment("1", 10, "a"), FakeAttachment("2", 20, "b")]
+        self.assertEqual(self.count(*attachments), 2)
+        self.assertEqual([a.downloads for a in attachments], [0, 0])
+
+    def test_same_content(self):
+        """Attachments with the same content (whatever their names) are uploaded as one file"""
+        self.assertEqual(self.count(FakeAttachment("1", 10, "a"), FakeAttachment("2", 10, "a"),
+                                    FakeAttachment("3", 10, "c"), FakeAttachment("4", 20, "d")), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
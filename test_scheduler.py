@@ -0,0 +1,67 @@
+from scheduler import Scheduler
+import threading
+import unittest
+import time
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.done = []
+        self.lock = threading.Lock()
+
+    def run_job(self, name, seconds=0.0):
+        time.sleep(seconds)
+        with self.lock:
+            self.done.append(name)
+        return name
+
+    def fail(self, name):
+        raise ValueError(name)
+
+    def test_dependencies(self):
+        """A job starts once all its dependencies are done, even if they are slower than the others"""
+        with Scheduler(4) as scheduler:
+            project = scheduler.add(self.run_job, "project", 0.05)
+            epic = scheduler.add(self.run_job, "epic", 0.1)
+            story = scheduler.add(self.run_job, "story", after=[project, epic, None])
+            comment = scheduler.add(self.run_job, "comment", after=[story])
+            other = scheduler.add(self.run_job, "other")
+            scheduler.wait()
+        self.assertEqual(self.done.index("other"), 0)
+        self.assertEqual(self.done[-2:], ["story", "comment"])
+        self.assertEqual([j.result for j in (project, epic, story, comment, other)],
+                         ["project", "epic", "story", "comment", "other"])
+
+    def test_done_dependency(self):
+        with Scheduler(1) as scheduler:
+            project = scheduler.add(self.run_job, "project")
+            scheduler.wait()
+            scheduler.add(self.run_job, "story", after=[project])
+            scheduler.wait()
+        self.assertEqual(self.done, ["project", "story"])
+
+    def test_error(self):
+        """After a failure, no other job is started, and the error is raised by wait()"""
+        with Scheduler(1) as scheduler:
+            failed = scheduler.add(self.fail, "project")
+            scheduler.add(self.run_job, "story", after=[failed])
+            scheduler.add(self.run_job, "other")
+            with self.assertRaisesRegex(ValueError, "project"):
+                scheduler.wait()
+        self.assertEqual(self.done, [])
+
+    def test_pending(self):
+        """wait(pending) returns as soon as at most 'pending' jobs are not done"""
+        release = threading.Event()
+        with Scheduler(2) as scheduler:
+            scheduler.add(release.wait)
+            for n in range(3):
+                scheduler.add(self.run_job, n)
+            scheduler.wait(1)
+            self.assertEqual(sorted(self.done), [0, 1, 2])
+            release.set()
+            scheduler.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
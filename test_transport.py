@@ -0,0 +1,78 @@
+from bench_servers import SyntheticWorkspace, ClubhouseStandIn
+from transport import PooledClient
+from requests import HTTPError
+import clubhouse
+import unittest
+import time
+
+
+class FlakyClubhouse(ClubhouseStandIn):
+    """Clubhouse stand-in answering the given writes with a 503 once, after they are done"""
+    def __init__(self, workspace, **kwargs):
+        super().__init__(workspace, **kwargs)
+        self.failures = []  # (method, path) of the next writes to fail
+
+    def handle(self, method, path, params, body):
+        status, response, headers = super().handle(method, path, params, body)
+        if (method, path) in self.failures:
+            self.failures.remove((method, path))
+            return 503, {"message": "Injected error"}, {}
+        return status, response, headers
+
+
+class PooledClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.standin = FlakyClubhouse(SyntheticWorkspace(epics=0, stories=0))
+        cls.host = clubhouse.ENDPOINT_HOST
+        clubhouse.ENDPOINT_HOST = cls.standin.serve()
+
+    @classmethod
+    def tearDownClass(cls):
+        clubhouse.ENDPOINT_HOST = cls.host
+
+    def setUp(self):
+        self.client = PooledClient("test")
+        self.client.backoff = 0.01
+
+    def test_post_done_before_error(self):
+        """The creation is done but answered with a 503: it is found by its external id, and not done twice"""
+        self.standin.failures.append(("POST", "/api/v3/epics"))
+        epic = self.client.post('epics', json={"name": "Epic", "external_id": "JIRA_POST-1"})
+        self.assertEqual([e['id'] for e in self.standin.epics.values() if e['external_id'] == "JIRA_POST-1"], [epic['id']])
+
+    def test_bulk_done_before_error(self):
+        """The stories of a failed batch are found, and only the missing ones are created again"""
+        self.client.post('stories', json={"name": "Saved", "external_id": "JIRA_BULK-1"})
+        self.standin.failures.append(("POST", "/api/v3/stories/bulk"))
+        stories = self.client.post('stories', 'bulk', json={"stories": [
+            {"name": "Story {}".format(n), "external_id": "JIRA_BULK-{}".format(n)} for n in (2, 3)]})
+        self.assertEqual(sorted(s['external_id'] for s in stories), ["JIRA_BULK-2", "JIRA_BULK-3"])
+        created = [s['external_id'] for s in self.standin.stories.values() if s['external_id'].startswith("JIRA_BULK-")]
+        self.assertEqual(sorted(created), ["JIRA_BULK-1", "JIRA_BULK-2", "JIRA_BULK-3"])
+
+    def test_throttled(self):
+        """A throttled request (429) is retried once the rate limit allows it"""
+        self.standin.rate, self.standin.burst, self.standin.tokens, self.standin.refilled = 100, 1, 0, time.time()
+        try:
+            self.assertEqual(self.client.get('projects'), list(self.standin.projects.values()))
+        finally:
+            self.standin.rate = 0
+        self.assertEqual(self.standin.stats["GET /api/v3/projects"]["errors"], 1)
+
+    def test_delete_done_before_error(self):
+        """The deletion is done but answered with a 503: its retry gets a 404, which is a success"""
+        project = self.client.post('projects', json={"name": "Deleted", "external_id": "DEL"})
+        self.standin.failures.append(("DELETE", "/api/v3/projects/{}".format(project['id'])))
+        self.assertEqual(self.client.delete('projects', project['id']), {})
+        self.assertNotIn(project['id'], self.standin.projects)
+        self.assertEqual(self.standin.failures, [])
+
+    def test_delete_missing(self):
+        """Without a failed attempt, a 404 is still an error"""
+        with self.assertRaises(HTTPError):
+            self.client.delete('projects', 10 ** 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+from clubhouse import ClubhouseClient
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from os import path
+import clubhouse
+import requests
+import threading
+import logging
+import random
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the threads of a process: at most 'rate' requests per second on average,
+    by bursts of at most 'burst' requests.
+    The rate is adaptive: when the server rejects a request (429), all the requests are paused and the rate
+    is reduced, then it recovers progressively with the successful requests
+    """
+    def __init__(self, rate, burst=10):
+        self.max_rate = self.rate = rate  # 0 = no limit (but the pauses requested by the server are honored)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request can be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if not self.max_rate:
+                        return
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self, seconds):
+        """Pause all the requests for the given time, and reduce the rate"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+            if self.max_rate:
+                self.rate = max(self.max_rate / 10, self.rate * 0.75)
+
+    def success(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 1000)
+
+
+class PooledClient(ClubhouseClient):
+    """
+    Clubhouse client sending its requests through a pool of keep-alive connections, at the rate allowed
+    by the API (see RateLimiter), and retrying the requests that fail:
+    - throttled requests (429) are retried after the delay given by the Retry-After header
+    - server errors (5xx), timeouts and connection errors are retried with an exponential backoff.
+      A creation (POST) that failed this way may have been done by the server: before it is retried, the object
+      is searched by its external id (see find_created()), so that it is not created twice.
+      Likewise, a deletion that failed this way may have been done: if its retry finds nothing to delete (404),
+      the deletion succeeded
+    """
+    retries = 5
+    backoff = 1.0  # seconds before the first retry (doubled at each retry)
+    timeout = 60
+    retry_status = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_key, workers=1, rate=0, burst=10):
+        """
+        :param workers: number of concurrent requests (size of the connection pool)
+        :param rate: max number of requests per second (0 = no limit)
+        """
+        super().__init__(api_key)
+        self.session = requests.Session()
+        self.session.headers["Clubhouse-Token"] = api_key  # instead of the token parameter: kept out of the urls
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 10))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.limiter = RateLimiter(rate, burst)
+
+    def _request(self, method, *segments, **kwargs):
+        if not str(segments[0]).startswith(clubhouse.ENDPOINT_PATH):
+            segments = [clubhouse.ENDPOINT_PATH, *segments]
+        url = path.join(clubhouse.ENDPOINT_HOST, *[str(s).strip("/") for s in segments])
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            for name, f, *mime in kwargs.get('files', {}).values():
+                f.seek(0)  # file sent again
+            self.limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if response.status_code not in self.retry_status:
+                    break
+                error = "status {}".format(response.status_code)
+                delay = self.retry_after(response)
+                if response.status_code == 429:
+                    self.limiter.slow_down(delay or self.backoff)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                response, error, delay = None, type(e).__name__, None
+            if attempt == self.retries:
+                break
+            delay = delay or self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            logging.warning("Clubhouse {} {} failed ({}), retry in {:.1f}s".format(
+                method.upper(), "/".join(str(s) for s in segments[1:]), error, delay))
+            time.sleep(delay)
+            if method == 'post' and (response is None or response.status_code != 429):
+                created = self.find_created(segments[1:], kwargs.get('json'))
+                if created:
+                    return created
+        if method == 'delete' and response.status_code == 404 and attempt > 0:
+            logging.info("Clubhouse DELETE {} was done by the failed attempt".format(
+                "/".join(str(s) for s in segments[1:])))
+            return {}
+        if response.status_code > 299:
+            logging.error("Status code: {}, Content: {}".format(response.status_code, response.text))
+            response.raise_for_status()
+        self.limiter.success()
+        if response.status_code == 204:
+            return {}
+        return response.json()
+
+    @staticmethod
+    def retry_after(response):
+        """The delay (seconds) given by the Retry-After header (a number of seconds or a date), or None"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+
+    def find_created(self, segments, payload):
+        """
+        Search the object that a failed creation may have created, by its external id
+        :return: the object (for the bulk endpoint, the list of the stories), or None if it was not created
+        """
+        segments = [str(s) for s in segments]
+        if not payload:
+            return None
+        if segments in (['projects'], ['epics']):
+            return next((o for o in self.get(segments[0]) if o.get('external_id') == payload.get('external_id')), None)
+        if segments == ['stories']:
+            return self.find_story(payload['external_id'])
+        if segments == ['stories', 'bulk']:
+            found = [self.find_story(s['external_id']) for s in payload['stories']]
+            missing = [s for s, f in zip(payload['stories'], found) if not f]
+            if len(missing) == len(found):
+                return None
+            logging.info("{} stories of the failed batch were created".format(len(found) - len(missing)))
+            return [f for f in found if f] + (self.post('stories', 'bulk', json={"stories": missing}) if missing else [])
+        if len(segments) == 3 and segments[0] == 'stories' and segments[2] in ('comments', 'tasks'):
+            story = self.get('stories', segments[1])
+            return next((o for o in story.get(segments[2], []) if o.get('external_id') == payload.get('external_id')), None)
+        if segments == ['story-links']:
+            story = self.get('stories', payload['subject_id'])
+            return next((l for l in story.get('story_links', []) if l.get('object_id') == payload['object_id']
+                         and l.get('subject_id') == payload['subject_id'] and l.get('verb') == payload['verb']), None)
+        return None  # e.g. files: no external id, the file may be uploaded twice
+
+    def find_story(self, external_id):
+        stories = self.post('stories', 'search', json={"external_id": external_id})
+        return stories[0] if stories else None